@@ -55,6 +55,9 @@ def main():
             'videomd@git+https://gitlab.csc.fi/dpres/videomd.git@develop',
             'file_scraper@git+https://gitlab.csc.fi/dpres/file-scraper.git@develop'
         ],
+        extras_require={
+            'zstd': ['zstandard']
+        },
         entry_points={'console_scripts': scripts_list()}
 
     )
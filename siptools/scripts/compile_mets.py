@@ -4,9 +4,13 @@ directory.
 from __future__ import unicode_literals
 
 import datetime
+import errno
+import fcntl
+import hashlib
 import os
 import sys
 import uuid
+from functools import partial
 from shutil import copyfile
 
 import click
@@ -16,12 +20,24 @@ import lxml.etree
 import mets
 import xml_helpers.utils as xml_utils
 from scandir import scandir
-from siptools.utils import get_objectlist
+from siptools.scripts.create_addml import add_flat_files
+from siptools.utils import (FLATFILES_SUFFIX, METS_PART_SUFFIXES,
+                            WORK_FILE_SUFFIXES, get_objectlist, parallel_map,
+                            verify_fixity, workspace_fixity)
 from siptools.xml.mets import (METS_CATALOG, METS_PROFILE, METS_SPECIFICATION,
                                NAMESPACES, RECORD_STATUS_TYPES, mets_extend)
 
 click.disable_unicode_literals_warning = True
 
+# Order of the amdSec child elements required by the METS schema
+AMDSEC_CHILD_ORDER = ['techMD', 'rightsMD', 'sourceMD', 'digiprovMD']
+
+# Methods for copying digital objects to workspace
+COPY_METHODS = ['copy', 'reflink', 'hardlink', 'auto']
+
+# Linux ioctl request for cloning a file (reflink)
+FICLONE = 0x40049409
+
 
 @click.command()
 @click.argument('mets_profile', type=click.Choice(METS_PROFILE))
@@ -72,6 +88,17 @@ click.disable_unicode_literals_warning = True
 @click.option('--copy_files',
               is_flag=True,
               help='Copy digital objects from base path to workspace')
+@click.option('--copy_method',
+              type=click.Choice(COPY_METHODS),
+              default='copy',
+              metavar='<COPY METHOD>',
+              help='Method for copying digital objects with --copy_files: '
+                   '"copy", "reflink", "hardlink" or "auto". Reflinks and '
+                   'hard links fall back to copying if the file system '
+                   'does not support them. Note that the workspace and '
+                   'base path share the data of hard linked files. '
+                   '"auto" tries hard link, reflink and copy in this '
+                   'order. Defaults to "copy".')
 @click.option('--stdout',
               is_flag=True,
               help='Print output to stdout.')
@@ -80,9 +107,20 @@ click.disable_unicode_literals_warning = True
               metavar='<PACKAGING SERVICE>',
               help='If defined, add packaging service as CREATOR '
                    'agent to METS Header.')
+@click.option('--digest',
+              is_flag=True,
+              help='Print SHA-1 digest of mets.xml calculated while writing '
+                   'the file. The digest can be given to sign-mets.')
+@click.option('--workers',
+              type=int, default=1,
+              metavar='<WORKERS>',
+              help='Number of worker processes used for reading the '
+                   'partial METS documents and threads used for copying '
+                   'digital objects. Defaults to 1.')
 def main(mets_profile, organization_name, contractid, objid, label,
          contentid, create_date, last_moddate, record_status, workspace,
-         clean, copy_files, base_path, stdout, packagingservice):
+         clean, copy_files, copy_method, base_path, stdout, packagingservice,
+         digest, workers):
     """Merge partial METS documents in workspace directory into
     one METS document.
 
@@ -94,7 +132,7 @@ def main(mets_profile, organization_name, contractid, objid, label,
     compile_mets(
         mets_profile, organization_name, contractid, objid, label, contentid,
         create_date, last_moddate, record_status, workspace, clean, copy_files,
-        base_path, stdout, packagingservice
+        base_path, stdout, packagingservice, workers, copy_method, digest
     )
     return 0
 
@@ -103,9 +141,14 @@ def compile_mets(mets_profile, organization_name, contractid, objid=None,
                  label=None, contentid=None, create_date=None,
                  last_moddate=None, record_status="submission",
                  workspace="./workspace", clean=False, copy_files=False,
-                 base_path=".", stdout=False, packagingservice=None):
+                 base_path=".", stdout=False, packagingservice=None,
+                 workers=1, copy_method="copy", digest=False):
     """Merge partial METS documents in workspace directory into
-    one METS document."""
+    one METS document.
+
+    :returns: SHA-1 digest of the written METS document if ``digest`` is
+              True, otherwise None
+    """
     contract = "urn:uuid:%s" % contractid
 
     if not objid:
@@ -125,7 +168,8 @@ def compile_mets(mets_profile, organization_name, contractid, objid=None,
                             "LASTMODDATE": last_moddate,
                             "RECORDSTATUS": record_status},
         organization=organization_name,
-        packagingservice=packagingservice
+        packagingservice=packagingservice,
+        workers=workers
     )
 
     if stdout:
@@ -136,22 +180,34 @@ def compile_mets(mets_profile, organization_name, contractid, objid=None,
     if not os.path.exists(os.path.dirname(output_file)):
         os.makedirs(os.path.dirname(output_file))
 
+    mets_data = xml_utils.serialize(mets_document.getroot())
     with open(output_file, 'wb+') as outfile:
-        outfile.write(xml_utils.serialize(mets_document.getroot()))
+        outfile.write(mets_data)
 
     print("compile_mets created file: %s" % output_file)
 
+    # The digest is calculated from the data written, so that signing
+    # does not need to read the file again
+    mets_digest = None
+    if digest:
+        mets_digest = hashlib.sha1(mets_data).hexdigest()
+        print("compile_mets SHA-1 digest of %s: %s" % (output_file,
+                                                       mets_digest))
+
     if copy_files:
-        copy_objects(workspace, base_path)
-        print("compile_mets copied objects from %s to workspace" % base_path)
+        copied = copy_objects(workspace, base_path, copy_method, workers)
+        print("compile_mets copied %d objects from %s to workspace" %
+              (copied, base_path))
 
     if clean:
         clean_metsparts(workspace)
         print("compile_mets cleaned work files from workspace")
 
+    return mets_digest
+
 
 def create_mets(workspace, mets_attributes, metshdr_attributes,
-                organization, packagingservice=None):
+                organization, packagingservice=None, workers=1):
     """Creates METS document element tree. Looks for files with prefix
     "-amd.xml", "dmdsec.xml", "structmap.xml", "filesec.xml", and
     "rightsmd.xml" from workspace and merges the dmdSec,
@@ -169,6 +225,7 @@ def create_mets(workspace, mets_attributes, metshdr_attributes,
     :param organization: name of CREATOR agent
     :param packagingservice: Add ``packagingservice`` as CREATOR agent.
                              ``organization`` is used as ARCHIVIST agent.
+    :param workers: Number of worker processes used for parsing the files
     :returns: METS document ElementTree object
     """
     # Create list of agent elements
@@ -188,16 +245,17 @@ def create_mets(workspace, mets_attributes, metshdr_attributes,
                            agents)
 
     # Collect elements from workspace XML files
-    elements = []
-    for entry in scandir(workspace):
-        if entry.name.endswith(('-amd.xml', 'dmdsec.xml',
-                                'structmap.xml', 'filesec.xml',
-                                'rightsmd.xml')) and entry.is_file():
-            element = lxml.etree.parse(entry.path).getroot()[0]
-            elements.append(element)
-
-    elements = mets.merge_elements('{%s}amdSec' % NAMESPACES['mets'], elements)
-    elements.sort(key=mets.order)
+    paths = [entry.path for entry in scandir(workspace)
+             if entry.name.endswith(METS_PART_SUFFIXES) and entry.is_file()]
+    if workers > 1:
+        sections = (
+            lxml.etree.fromstring(section) for section in parallel_map(
+                _serialized_section, paths, workers, chunksize=100)
+        )
+    else:
+        sections = (read_section(path) for path in paths)
+
+    elements = merge_sections(sections)
 
     # Create METS element
     mets_element = mets.mets(METS_PROFILE[mets_attributes["PROFILE"]],
@@ -217,27 +275,230 @@ def create_mets(workspace, mets_attributes, metshdr_attributes,
     return lxml.etree.ElementTree(mets_element)
 
 
+def merge_sections(sections):
+    """Merge METS section elements into a list of sections in METS order.
+    The children of all amdSec elements are moved directly into a single
+    amdSec element in the order required by the METS schema, so that the
+    parsed documents do not have to be kept in memory. Sections and amdSec
+    children with an ID that has already been merged are dropped.
+
+    :param sections: Iterable of METS section elements
+    :returns: List of METS section elements sorted in METS order
+    """
+    amdsec_tag = '{%s}amdSec' % NAMESPACES['mets']
+    amd_order = ['{%s}%s' % (NAMESPACES['mets'], tag)
+                 for tag in AMDSEC_CHILD_ORDER]
+    amdsec = None
+    last_children = {}
+    merged_ids = set()
+    elements = []
+
+    for section in sections:
+        if section.tag != amdsec_tag:
+            section_id = section.get('ID')
+            if section_id is None or section_id not in merged_ids:
+                merged_ids.add(section_id)
+                elements.append(section)
+            continue
+
+        if amdsec is None:
+            amdsec = mets.amdsec()
+            elements.append(amdsec)
+
+        for child in list(section.iterchildren(amd_order)):
+            child_id = child.get('ID')
+            if child_id is not None and child_id in merged_ids:
+                continue
+            merged_ids.add(child_id)
+
+            # Add the child after the last merged element of the same or
+            # a preceding type
+            index = amd_order.index(child.tag)
+            for tag in reversed(amd_order[:index + 1]):
+                if tag in last_children:
+                    last_children[tag].addnext(child)
+                    break
+            else:
+                amdsec.insert(0, child)
+            last_children[child.tag] = child
+
+    elements.sort(key=mets.order)
+    return elements
+
+
+def read_section(path):
+    """Read the METS section element from a partial METS document. The
+    flatFile elements appended for ADDML metadata are merged into it.
+
+    :param path: Path to the partial METS document
+    :returns: The first child element of the mets root element
+    """
+    root = lxml.etree.parse(path).getroot()
+    if path.endswith('-ADDML-amd.xml') and \
+            os.path.isfile(path + FLATFILES_SUFFIX):
+        add_flat_files(root, path + FLATFILES_SUFFIX)
+    return root[0]
+
+
+def _serialized_section(path):
+    """Read the METS section element from a partial METS document in a
+    worker process. Elements can not be passed between processes, so the
+    element is returned serialized.
+
+    :param path: Path to the partial METS document
+    :returns: Serialized METS section element
+    """
+    return lxml.etree.tostring(read_section(path))
+
+
 def clean_metsparts(path):
-    """Clean mets parts from workspace
+    """Clean mets parts from workspace. The work files are always written
+    to the root of the workspace, so the subdirectories containing copied
+    digital objects are not walked through. Digital objects copied to the
+    root of the workspace are not removed.
+    """
+    objects = set()
+    if os.path.isfile(os.path.join(path, 'md-references.xml')):
+        objects = set(get_objectlist(path))
+
+    for entry in scandir(path):
+        if entry.name.endswith(WORK_FILE_SUFFIXES) and entry.is_file() \
+                and entry.name not in objects:
+            os.remove(entry.path)
+
+
+def copy_objects(workspace, data_dir, method='copy', workers=1):
+    """Copy digital objects to workspace. Objects already found in the
+    workspace are not copied again, if their size and the checksum
+    recorded as PREMIS fixity match.
+
+    :param workspace: Workspace path
+    :param data_dir: Base path of the digital objects
+    :param method: Copy method, one of ``COPY_METHODS``
+    :param workers: Number of threads copying the objects
+    :returns: Number of copied objects
     """
-    for root, _, files in os.walk(path, topdown=False):
-        for name in files:
-            if (name.endswith(('-amd.xml', 'dmdsec.xml', 'structmap.xml',
-                               'filesec.xml', 'rightsmd.xml',
-                               'md-references.xml',
-                               '-scraper.pkl'))):
-                os.remove(os.path.join(root, name))
+    fixity = workspace_fixity(workspace)
+    files = [
+        (os.path.join(data_dir, source), os.path.join(workspace, source),
+         fixity.get(source, {}))
+        for source in get_objectlist(workspace)
+    ]
+    copied = parallel_map(partial(_copy_object, method=method), files,
+                          workers, threads=True)
+
+    return sum(copied)
 
 
-def copy_objects(workspace, data_dir):
-    """Copy digital objects to workspace
+def _copy_object(args, method='copy'):
+    """Copy one digital object, unless an identical target exists.
+
+    :param args: Tuple of source path, target path and PREMIS fixity
+                 as a dict of algorithms and checksums
+    :param method: Copy method, one of ``COPY_METHODS``
+    :returns: True if the object was copied, False if it was skipped
     """
-    files = get_objectlist(workspace)
-    for source in files:
-        target = os.path.join(workspace, source)
-        if not os.path.exists(os.path.dirname(target)):
+    source, target, fixity = args
+    if _target_matches(source, target, fixity):
+        return False
+
+    if not os.path.exists(os.path.dirname(target)):
+        try:
             os.makedirs(os.path.dirname(target))
-        copyfile(os.path.join(data_dir, source), target)
+        except OSError as exception:
+            # Another thread may have created the directory
+            if exception.errno != errno.EEXIST:
+                raise
+
+    copy_functions = {
+        'copy': [_copy_file_range],
+        'reflink': [_reflink, _copy_file_range],
+        'hardlink': [os.link, _copy_file_range],
+        'auto': [os.link, _reflink, _copy_file_range]
+    }
+    for copy_function in copy_functions[method]:
+        if os.path.lexists(target):
+            os.remove(target)
+        try:
+            copy_function(source, target)
+        except (IOError, OSError):
+            continue
+        if _copy_complete(source, target):
+            return True
+
+    if os.path.lexists(target):
+        os.remove(target)
+    copyfile(source, target)
+    return True
+
+
+def _target_matches(source, target, fixity):
+    """Check if the target already contains the source data. A target
+    linked to the source matches always. Otherwise the sizes of the files
+    must be equal and the checksum of the target must match the fixity.
+
+    :param source: Source path
+    :param target: Target path
+    :param fixity: Dict of checksum algorithms and checksums
+    :returns: True if the target does not have to be copied
+    """
+    if not os.path.isfile(target):
+        return False
+    if os.path.samefile(source, target):
+        return True
+    if not fixity:
+        return False
+    if os.path.getsize(source) != os.path.getsize(target):
+        return False
+
+    return bool(verify_fixity(target, fixity))
+
+
+def _copy_complete(source, target):
+    """Check that a copy made by a fast copy method is complete. The
+    sizes of the files must be equal. The data is not read back, so that
+    linked and cloned copies stay fast.
+
+    :param source: Source path
+    :param target: Target path
+    :returns: True if the copy is complete
+    """
+    return os.path.getsize(source) == os.path.getsize(target)
+
+
+def _reflink(source, target):
+    """Create a copy-on-write clone of the source file, if the file system
+    supports it.
+
+    :param source: Source path
+    :param target: Target path
+    :raises: IOError or OSError if cloning is not supported
+    """
+    with open(source, 'rb') as infile, open(target, 'wb') as outfile:
+        fcntl.ioctl(outfile.fileno(), FICLONE, infile.fileno())
+
+
+def _copy_file_range(source, target):
+    """Copy the source file in kernel space with copy_file_range(), which
+    may also share the data blocks on file systems supporting it.
+
+    :param source: Source path
+    :param target: Target path
+    :raises: OSError if copy_file_range() is not supported or it stops
+             before the whole file is copied
+    """
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError(errno.ENOSYS, 'copy_file_range is not available')
+
+    with open(source, 'rb') as infile, open(target, 'wb') as outfile:
+        remaining = os.fstat(infile.fileno()).st_size
+        while remaining > 0:
+            copied = os.copy_file_range(
+                infile.fileno(), outfile.fileno(), remaining)
+            if copied == 0:
+                raise OSError(errno.EIO, 'copy_file_range stopped with %d '
+                              'bytes remaining' % remaining, source)
+            remaining -= copied
 
 
 if __name__ == '__main__':
@@ -12,7 +12,8 @@ import click
 import lxml.etree as ET
 import mets
 import xml_helpers.utils as xml_utils
-from siptools.utils import add, encode_path, get_objectlist, tree
+from siptools.utils import (add, encode_path, file_md_references,
+                            get_objectlist, parallel_map, tree)
 from siptools.xml.mets import NAMESPACES
 
 click.disable_unicode_literals_warning = True
@@ -20,6 +21,10 @@ click.disable_unicode_literals_warning = True
 ALLOWED_C_SUBS = ['c', 'c01', 'c02', 'c03', 'c04', 'c05', 'c06', 'c07',
                   'c08', 'c09', 'c10', 'c11', 'c12']
 
+# Maximum number of files in a part of the file list processed in one
+# worker task
+SHARD_SIZE = 1000
+
 
 def ead3_ns(tag):
     """Get tag with EAD3 namespace
@@ -49,21 +54,29 @@ def ead3_ns(tag):
 @click.option('--stdout',
               is_flag=True,
               help='Print output also to stdout.')
-def main(workspace, structmap_type, root_type, dmdsec_loc, stdout):
+@click.option('--workers',
+              type=int, default=1,
+              metavar='<WORKERS>',
+              help="Number of worker processes used for creating the file "
+                   "section. Defaults to 1.")
+def main(workspace, structmap_type, root_type, dmdsec_loc, stdout, workers):
     """Tool for generating METS file section and structural map based on
     created/imported administrative metada and descriptive metadata.
     The script will also add order of the file to the structural map
     (via pickle file), if --order argument was used in import_object script.
     """
-    compile_structmap(workspace, structmap_type, root_type, dmdsec_loc, stdout)
+    compile_structmap(workspace, structmap_type, root_type, dmdsec_loc, stdout,
+                      workers)
 
     return 0
 
 
 def compile_structmap(workspace="./workspace/", structmap_type=None,
-                      root_type=None, dmdsec_loc=None, stdout=False):
+                      root_type=None, dmdsec_loc=None, stdout=False,
+                      workers=1):
     """Generate METS file section and structural map based on
     created/imported administrative metada and descriptive metadata.
+    The file section is created with ``workers`` worker processes.
     """
     filelist = get_objectlist(workspace)
 
@@ -78,7 +91,7 @@ def compile_structmap(workspace="./workspace/", structmap_type=None,
         structmap = create_ead3_structmap(dmdsec_loc, workspace,
                                           filegrp, filelist, structmap_type)
     else:
-        filesec = create_filesec(workspace, filelist)
+        filesec = create_filesec(workspace, filelist, workers)
         structmap = create_structmap(workspace, filesec.getroot(),
                                      filelist, structmap_type, root_type)
 
@@ -105,13 +118,13 @@ def compile_structmap(workspace="./workspace/", structmap_type=None,
                                                       output_fs_file))
 
 
-def create_filesec(workspace, filelist):
+def create_filesec(workspace, filelist, workers=1):
     """Creates METS document element tree that contains fileSec element.
     """
     filegrp = mets.filegrp()
     filesec = mets.filesec(child_elements=[filegrp])
 
-    create_filegrp(workspace, filegrp, filelist)
+    create_filegrp(workspace, filegrp, filelist, workers)
 
     mets_element = mets.mets(child_elements=[filesec])
     ET.cleanup_namespaces(mets_element)
@@ -192,10 +205,12 @@ def create_ead3_structmap(descfile, workspace, filegrp, filelist, type_attr):
     div_ead = mets.div(type_attr='archdesc', label=label, dmdid=dmdids,
                        admid=amdids)
 
+    references = file_md_references(workspace)
     if len(root.xpath("//ead3:archdesc/ead3:dsc", namespaces=NAMESPACES)) > 0:
         for elem in root.xpath("//ead3:dsc/*", namespaces=NAMESPACES):
             if ET.QName(elem.tag).localname in ALLOWED_C_SUBS:
-                ead3_c_div(elem, div_ead, filegrp, workspace, filelist)
+                ead3_c_div(elem, div_ead, filegrp, workspace, filelist,
+                           references)
 
     container_div.append(div_ead)
     structmap.append(container_div)
@@ -204,7 +219,8 @@ def create_ead3_structmap(descfile, workspace, filegrp, filelist, type_attr):
     return ET.ElementTree(mets_element)
 
 
-def ead3_c_div(parent, structmap, filegrp, workspace, filelist):
+def ead3_c_div(parent, structmap, filegrp, workspace, filelist,
+               references=None):
     """Create div elements based on ead3 c elements. Fptr elements are
     created based on ead dao elements. The Ead3 elements tags are put
     into @type and the @level or @otherlevel attributes from ead3 will
@@ -215,6 +231,7 @@ def ead3_c_div(parent, structmap, filegrp, workspace, filelist):
     :filegrp: fileGrp element
     :workspace: Workspace path
     :filelist: Sorted list of digital objects (file paths)
+    :references: File references grouped by ``file_md_references``
     """
 
     try:
@@ -227,30 +244,37 @@ def ead3_c_div(parent, structmap, filegrp, workspace, filelist):
 
     for elem in parent.findall("./*"):
         if ET.QName(elem.tag).localname in ALLOWED_C_SUBS:
-            ead3_c_div(elem, c_div, filegrp, workspace, filelist)
+            ead3_c_div(elem, c_div, filegrp, workspace, filelist,
+                       references)
 
     hrefs = collect_dao_hrefs(parent)
     c_div = add_fptrs_div_ead(
         c_div=c_div, hrefs=hrefs, filelist=filelist,
-        filegrp=filegrp, workspace=workspace)
+        filegrp=filegrp, workspace=workspace, references=references)
 
     structmap.append(c_div)
 
 
-def add_file_to_filesec(workspace, path, filegrp):
+def add_file_to_filesec(workspace, path, filegrp, file_references=None):
     """Add file element to fileGrp element given as parameter.
 
     :param workspace: Workspace directorye from which administrative MD
                       files and amd reference files searched.
     :param path: url encoded path of the file
     :param lxml.etree.Element filegrp: fileGrp element
+    :param dict file_references: References of the file as grouped by
+                                 ``file_md_references``. Read from the
+                                 workspace if not given.
     :param str returns: id of file added to fileGrp
     :returns: unique identifier of file element
     """
     fileid = '_{}'.format(uuid4())
 
+    if file_references is None:
+        file_references = file_md_references(workspace).get(path, {})
+
     # Create list of IDs of amdID elements
-    amdids = get_md_references(workspace, path=path)
+    amdids = file_references.get('amdids', set())
 
     # Create XML element and add it to fileGrp
     file_el = mets.file_elem(
@@ -262,13 +286,10 @@ def add_file_to_filesec(workspace, path, filegrp):
         groupid=None
     )
 
-    streams = get_objectlist(workspace, path)
-    if streams:
-        for stream in streams:
-            stream_ids = get_md_references(workspace, path=path,
-                                           stream=stream)
-            stream_el = mets.stream(admid_elements=stream_ids)
-            file_el.append(stream_el)
+    streams = file_references.get('streams', {})
+    for stream in sorted(streams):
+        stream_el = mets.stream(admid_elements=streams[stream])
+        file_el.append(stream_el)
 
     filegrp.append(file_el)
 
@@ -388,16 +409,78 @@ def create_div(workspace, divs, parent, filesec, filelist, path='',
         parent.append(div_elem)
 
 
-def create_filegrp(workspace, filegrp, filelist):
+def create_filegrp(workspace, filegrp, filelist, workers=1):
     """Add files to fileSec under fileGrp element.
 
+    If more than one worker is given, the file list is split into parts
+    with shard_filelist and the file elements of the parts are created in
+    worker processes. The parts are added to the fileGrp element in the
+    order of the file list.
+
     :param workspace: Workspace path
     :param filegrp: filegrp element in fileSec
-    :param filelist: Set of digital objects (file paths)
+    :param filelist: Sorted list of digital objects (file paths)
+    :param workers: Number of worker processes
     :returns: ``None``
     """
+    references = file_md_references(workspace)
+
+    if workers <= 1:
+        for path in filelist:
+            add_file_to_filesec(workspace, path, filegrp,
+                                references.get(path, {}))
+        return
+
+    shards = [
+        (workspace, [(path, references.get(path, {})) for path in shard])
+        for shard in shard_filelist(filelist)
+    ]
+    # Send several parts to a worker at a time, but keep all the workers
+    # busy
+    chunksize = max(1, len(shards) // (4 * workers))
+    for fragment in parallel_map(_filegrp_fragment, shards, workers,
+                                 chunksize=chunksize):
+        filegrp.extend(list(ET.fromstring(fragment)))
+
+
+def shard_filelist(filelist, shard_size=SHARD_SIZE):
+    """Split a sorted file list into lists of files sharing the same
+    top-level directory. Consecutive files at the top level share a list,
+    and lists longer than ``shard_size`` are split. The files of a
+    top-level directory are consecutive in a sorted list, so the order of
+    the files is preserved when the lists are concatenated.
+
+    :param filelist: Sorted list of digital objects (file paths)
+    :param shard_size: Maximum number of files in a list
+    :returns: List of file lists
+    """
+    shards = []
+    previous = None
     for path in filelist:
-        add_file_to_filesec(workspace, path, filegrp)
+        top_level = path.split('/', 1)[0] if '/' in path else None
+        if not shards or top_level != previous or \
+                len(shards[-1]) >= shard_size:
+            shards.append([])
+            previous = top_level
+        shards[-1].append(path)
+
+    return shards
+
+
+def _filegrp_fragment(args):
+    """Create file elements for a part of the file list in a worker
+    process.
+
+    :param args: Tuple of workspace path and list of tuples of file path
+                 and the references of the file
+    :returns: Serialized fileGrp element containing the file elements
+    """
+    workspace, files = args
+    filegrp = mets.filegrp()
+    for path, file_references in files:
+        add_file_to_filesec(workspace, path, filegrp, file_references)
+
+    return ET.tostring(filegrp)
 
 
 def add_file_div(workspace, path, fptr, type_attr='file'):
@@ -449,7 +532,8 @@ def file_properties(workspace, path):
     return file_metadata_dict[0]['properties']
 
 
-def add_fptrs_div_ead(c_div, hrefs, filelist, filegrp, workspace):
+def add_fptrs_div_ead(c_div, hrefs, filelist, filegrp, workspace,
+                      references=None):
     """Creates fptr elements for hrefs. If the files contain
     file properties, like ordering data, the data is written to the
     parent div element.
@@ -462,6 +546,8 @@ def add_fptrs_div_ead(c_div, hrefs, filelist, filegrp, workspace):
     :filelist: Sorted list of digital objects (file paths)
     :filegrp: fileGrp element
     :workspace: Workspace path
+    :references: File references grouped by ``file_md_references``. Read
+                 from the workspace for each file if not given.
 
     :returns: The modified c_div element
     """
@@ -473,7 +559,11 @@ def add_fptrs_div_ead(c_div, hrefs, filelist, filegrp, workspace):
             break
         amd_file = amd_file[0]
         properties = file_properties(workspace, amd_file)
-        fileid = add_file_to_filesec(workspace, amd_file, filegrp)
+        file_references = None
+        if references is not None:
+            file_references = references.get(amd_file, {})
+        fileid = add_file_to_filesec(workspace, amd_file, filegrp,
+                                     file_references)
         fptr = mets.fptr(fileid=fileid)
 
         if properties and 'order' in properties:
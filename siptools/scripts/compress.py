@@ -1,15 +1,64 @@
 """Command line tool for creating tar file from SIP directory"""
 from __future__ import unicode_literals
 
+import collections
+import grp
+import hashlib
+import io
+import os
+import pwd
+import stat
 import sys
-import subprocess
+import tarfile
+import time
+import zlib
+from multiprocessing.pool import ThreadPool
+
 import click
+import six
+
+from siptools.utils import (WORK_FILE_SUFFIXES, decode_path, encode_path,
+                            fsencode_path, get_objectlist, workspace_fixity)
 
-from siptools.utils import fsencode_path
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 click.disable_unicode_literals_warning = True
 
+# Files written to the beginning of the tar file in this order
+FIRST_MEMBERS = ['mets.xml', 'signature.sig']
+
+# Number of bytes read from a file at a time
+BUFFER_SIZE = 1024 * 1024
+
+# Largest file that is read ahead into the page cache
+READAHEAD_MAX_SIZE = 64 * 1024 * 1024
+
+# Number of upcoming files read ahead per read-ahead thread
+READAHEAD_WINDOW = 4
+
+# Supported compression formats of the tar file
+COMPRESSION_TYPES = ['none', 'gzip', 'zstd']
+
+# Number of bytes compressed as an independent gzip member
+GZIP_BLOCK_SIZE = 1024 * 1024
+
+# Compression level of gzip
+GZIP_LEVEL = 6
+
+# Suffix of the member index written next to the tar file
+INDEX_SUFFIX = '.index'
+
+# Checksum algorithm of the member index
+INDEX_CHECKSUM = 'MD5'
+
+# Entry of the member index
+TarIndexEntry = collections.namedtuple(
+    'TarIndexEntry', ['offset', 'offset_data', 'size', 'checksum'])
+
 
 @click.command()
 @click.argument('dir_to_tar', type=click.Path(exists=True))
@@ -17,29 +66,593 @@ click.disable_unicode_literals_warning = True
     '--tar_filename', type=str, default='sip.tar',
     metavar='<TAR FILE>',
     help="Filename for tar. Default is sip.tar")
-def main(dir_to_tar, tar_filename):
+@click.option(
+    '--readahead', type=int, default=0,
+    metavar='<THREADS>',
+    help="Number of threads reading upcoming files ahead. Default is 0.")
+@click.option(
+    '--compression', type=click.Choice(COMPRESSION_TYPES), default='none',
+    metavar='<COMPRESSION>',
+    help="Compress the tar file with \"gzip\" or \"zstd\". Default is "
+         "\"none\".")
+@click.option(
+    '--threads', type=int, default=1,
+    metavar='<THREADS>',
+    help="Number of compression threads. Default is 1.")
+@click.option(
+    '--base_path', type=click.Path(exists=True, file_okay=False),
+    metavar='<BASE PATH>',
+    help="Source base path of the digital objects. If given, DIR_TO_TAR is "
+         "a workspace, and the tar file is built from the METS document "
+         "and signature in the workspace and the digital objects listed in "
+         "the workspace, read from the base path. The objects do not need "
+         "to be copied to the workspace.")
+@click.option(
+    '--index', is_flag=True,
+    help="Write an index of the tar members with their offsets, sizes "
+         "and checksums to <TAR FILE>.index. Only for uncompressed tar "
+         "files.")
+def main(dir_to_tar, tar_filename, readahead, compression, threads,
+         base_path, index):
     """Create tar file from SIP directory.
 
     DIR_TO_TAR: Directory to be added in the TAR file.
     """
-    return compress(dir_to_tar, tar_filename)
+    return compress(dir_to_tar, tar_filename, readahead, compression,
+                    threads, base_path, index)
+
+
+def compress(dir_to_tar, tar_filename, readahead=0, compression='none',
+             threads=1, base_path=None, index=False):
+    """Create tar file from SIP directory. The files mets.xml and
+    signature.sig are written first and the rest of the directory in
+    sorted order. The tar file and the member index are left out, if
+    they are written inside the directory.
+
+    :param dir_to_tar: Directory to be added in the tar file
+    :param tar_filename: Path of the tar file
+    :param readahead: Number of threads reading upcoming files ahead
+    :param compression: Compression format, one of ``COMPRESSION_TYPES``
+    :param threads: Number of compression threads
+    :param base_path: Source base path of the digital objects. If given,
+                      dir_to_tar is a workspace and the objects are read
+                      from the base path.
+    :param index: True to write the member index to a file named as
+                  the tar file with ``INDEX_SUFFIX``. The checksums of
+                  the index are verified against the PREMIS fixity of
+                  the digital objects, if the workspace contains it.
+    :returns: 0 on success
+    :raises: ValueError if index is requested for a compressed tar file,
+             or if the written data does not match the PREMIS fixity
+    """
+    if index and compression != 'none':
+        raise ValueError("The member index can be written only for "
+                         "uncompressed tar files")
+
+    start = time.time()
+    if base_path is None:
+        members = iter_directory_members(dir_to_tar)
+    else:
+        members = iter_workspace_members(dir_to_tar, base_path)
+    index_file = None
+    if index:
+        index_file = io.open(fsencode_path(tar_filename + INDEX_SUFFIX),
+                             'wt', encoding='utf-8')
+    try:
+        with open(fsencode_path(tar_filename), 'wb') as tar_file:
+            output = compressed_output(tar_file, compression, threads)
+            writer = TarWriter(output, index=index_file)
+            members = skip_open_files(
+                members, [fileobj for fileobj in (tar_file, index_file)
+                          if fileobj is not None])
+            for path, arcname in readahead_members(members, readahead):
+                writer.add(path, arcname)
+            writer.close()
+            output.close()
+    finally:
+        if index_file is not None:
+            index_file.close()
+
+    elapsed = max(time.time() - start, 1e-6)
+    print("created tar file: %s (%d members, %d bytes, %.1f MB/s)" % (
+        tar_filename, writer.members, writer.offset,
+        writer.offset / elapsed / 1e6))
+
+    if index:
+        mismatches = verify_tar_index(
+            read_tar_index(tar_filename + INDEX_SUFFIX),
+            workspace_fixity(dir_to_tar))
+        if mismatches:
+            raise ValueError("Digital objects do not match their PREMIS "
+                             "fixity in %s: %s" % (tar_filename,
+                                                   ', '.join(mismatches)))
+
+    return 0
+
+
+def iter_directory_members(dir_to_tar):
+    """Iterate the paths and member names of a directory in the order
+    they are written to the tar file: the root directory, the files in
+    ``FIRST_MEMBERS``, and the rest of the directory in sorted order,
+    each directory followed by its files and subdirectories. Symbolic
+    links to directories are not followed, but they are members like
+    the files.
+
+    :param dir_to_tar: Directory to be added in the tar file
+    :returns: Generator of tuples of path and member name
+    """
+    yield dir_to_tar, '.'
+    for name in FIRST_MEMBERS:
+        path = os.path.join(dir_to_tar, name)
+        if os.path.isfile(path):
+            yield path, './%s' % name
+
+    for root, dirnames, filenames in os.walk(dir_to_tar):
+        dirnames.sort()
+        relroot = os.path.relpath(root, dir_to_tar)
+        if relroot != '.':
+            yield root, './%s' % relroot
+        dirlinks = [dirname for dirname in dirnames
+                    if os.path.islink(os.path.join(root, dirname))]
+        for filename in sorted(filenames + dirlinks):
+            if relroot == '.' and filename in FIRST_MEMBERS:
+                continue
+            yield (os.path.join(root, filename),
+                   './%s' % os.path.normpath(os.path.join(relroot, filename)))
+
+
+def iter_workspace_members(workspace, base_path):
+    """Iterate the paths and member names of a SIP that is not staged in
+    one directory. The package files, such as mets.xml and signature.sig,
+    are read from the workspace root, leaving out the work files of
+    siptools. The digital objects listed in md-references.xml of the
+    workspace are read from the base path. The parent directories of the
+    objects are added before the objects.
+
+    :param workspace: Workspace path
+    :param base_path: Source base path of the digital objects
+    :returns: Generator of tuples of path and member name
+    """
+    yield workspace, '.'
+    filenames = sorted(
+        filename for filename in os.listdir(workspace)
+        if os.path.isfile(os.path.join(workspace, filename))
+        and not filename.endswith(WORK_FILE_SUFFIXES))
+    for name in FIRST_MEMBERS:
+        if name in filenames:
+            filenames.remove(name)
+            yield os.path.join(workspace, name), './%s' % name
+    for filename in filenames:
+        yield os.path.join(workspace, filename), './%s' % filename
+
+    directories = set(['.'])
+    for path in get_objectlist(workspace):
+        parents = []
+        parent = os.path.dirname(path)
+        while parent and parent not in directories:
+            parents.append(parent)
+            directories.add(parent)
+            parent = os.path.dirname(parent)
+        for directory in reversed(parents):
+            yield os.path.join(base_path, directory), './%s' % directory
+        yield os.path.join(base_path, path), './%s' % path
+
+
+def skip_open_files(members, fileobjs):
+    """Leave out the members that are the given open files, such as the
+    tar file being written. The files are compared by their device and
+    inode numbers.
+
+    :param members: Iterable of tuples of path and member name
+    :param fileobjs: List of open file objects
+    :returns: Generator of the other members
+    """
+    skipped = set()
+    for fileobj in fileobjs:
+        stat_result = os.fstat(fileobj.fileno())
+        skipped.add((stat_result.st_dev, stat_result.st_ino))
+
+    for path, arcname in members:
+        stat_result = os.lstat(path)
+        if (stat_result.st_dev, stat_result.st_ino) in skipped:
+            continue
+        yield path, arcname
+
+
+def readahead_members(members, threads=0):
+    """Iterate members and read the upcoming small files into the page
+    cache in a pool of threads, so that the files can be read in parallel
+    on storage with high latency. The number of files read ahead is
+    bounded, so memory use does not depend on the number of members.
+
+    :param members: Iterable of tuples of path and member name
+    :param threads: Number of read-ahead threads, 0 to disable
+    :returns: Generator of the members
+    """
+    if threads <= 0:
+        for member in members:
+            yield member
+        return
+
+    pool = ThreadPool(threads)
+    pending = collections.deque()
+    try:
+        for member in members:
+            pending.append(
+                (member, pool.apply_async(_readahead, (member[0],))))
+            if len(pending) > threads * READAHEAD_WINDOW:
+                yield pending.popleft()[0]
+        while pending:
+            yield pending.popleft()[0]
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _readahead(path):
+    """Read a regular file into the page cache. Large files are skipped,
+    since they are read sequentially at full speed anyway and could evict
+    the files read ahead before them.
+
+    :param path: File path
+    """
+    try:
+        if not os.path.isfile(path) or \
+                os.path.getsize(path) > READAHEAD_MAX_SIZE:
+            return
+        with open(path, 'rb') as infile:
+            while infile.read(BUFFER_SIZE):
+                pass
+    except (IOError, OSError):
+        # Errors are reported when the file is added to the tar file
+        pass
+
+
+def compressed_output(fileobj, compression='none', threads=1):
+    """Return a writable file object compressing the data written to the
+    given file object.
+
+    :param fileobj: Writable file object
+    :param compression: Compression format, one of ``COMPRESSION_TYPES``
+    :param threads: Number of compression threads
+    :returns: Writable file object
+    :raises: ValueError if the compression is not supported
+    """
+    if compression == 'none':
+        return fileobj
+    if compression == 'gzip':
+        return ParallelGzipWriter(fileobj, threads)
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ValueError("zstd compression requires the zstandard "
+                             "module")
+        compressor = zstandard.ZstdCompressor(threads=threads)
+        return compressor.stream_writer(fileobj)
+
+    raise ValueError("Unsupported compression: %s" % compression)
+
+
+def _gzip_member(data):
+    """Compress data as a complete gzip member.
+
+    :param data: Data to compress
+    :returns: Compressed data
+    """
+    compressor = zlib.compressobj(
+        GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class ParallelGzipWriter(object):
+    """Writable file object compressing data with gzip in a pool of
+    threads. The data is split in blocks that are compressed as
+    independent gzip members, which are written in the original order.
+    A sequence of gzip members is a standard gzip file, which any gzip
+    implementation decompresses into the concatenated data. The number of
+    blocks being compressed is bounded, so memory use stays constant.
+    """
+
+    def __init__(self, fileobj, threads=1, block_size=GZIP_BLOCK_SIZE):
+        """
+        :fileobj: Writable file object for the compressed data
+        :threads: Number of compression threads
+        :block_size: Number of bytes compressed as one gzip member
+        """
+        self.fileobj = fileobj
+        self.threads = max(threads, 1)
+        self.block_size = block_size
+        self._buffer = []
+        self._buffered = 0
+        self._pending = collections.deque()
+        self._pool = ThreadPool(self.threads)
+        self._members = 0
+
+    def write(self, data):
+        """Buffer data and compress full blocks."""
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.block_size:
+            self._compress_buffer()
+
+    def _compress_buffer(self):
+        """Send buffered data to compression and write the compressed
+        blocks that are ready in order.
+        """
+        block = b''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        self._pending.append(self._pool.apply_async(_gzip_member, (block,)))
+        while len(self._pending) > self.threads * 2:
+            self._write_member()
+
+    def _write_member(self):
+        """Wait for the oldest block to be compressed and write it."""
+        self.fileobj.write(self._pending.popleft().get())
+        self._members += 1
+
+    def close(self):
+        """Compress and write the remaining data. The underlying file
+        object is not closed.
+        """
+        if self._buffered > 0 or (self._members == 0 and not self._pending):
+            self._compress_buffer()
+        while self._pending:
+            self._write_member()
+        self._pool.close()
+        self._pool.join()
+
+
+class TarWriter(object):
+    """Streaming writer for GNU tar files. Unlike tarfile.TarFile, no
+    list of the written members is kept, so memory use stays constant
+    regardless of the number of members.
+    """
+
+    def __init__(self, fileobj, buffer_size=BUFFER_SIZE, index=None):
+        """
+        :fileobj: Writable file object
+        :buffer_size: Number of bytes read from a file at a time
+        :index: Writable text file object for the member index, or None
+        :offset: Number of bytes written
+        :members: Number of members written
+        """
+        self.fileobj = fileobj
+        self.buffer_size = buffer_size
+        self.index = index
+        self.offset = 0
+        self.members = 0
+        self._owners = {}
+        self._groups = {}
+
+    def _write(self, data):
+        """Write data and update the offset."""
+        self.fileobj.write(data)
+        self.offset += len(data)
+
+    def tarinfo(self, path, arcname):
+        """Create tar header information for a file.
+
+        :path: File path
+        :arcname: Name of the member in the tar file
+        :returns: TarInfo object, or None for unsupported file types
+        """
+        stat_result = os.lstat(path)
+        tarinfo = tarfile.TarInfo(arcname)
+        tarinfo.mode = stat.S_IMODE(stat_result.st_mode)
+        tarinfo.uid = stat_result.st_uid
+        tarinfo.gid = stat_result.st_gid
+        tarinfo.mtime = int(stat_result.st_mtime)
+        tarinfo.uname = self._owner(stat_result.st_uid)
+        tarinfo.gname = self._group(stat_result.st_gid)
+
+        if stat.S_ISREG(stat_result.st_mode):
+            tarinfo.type = tarfile.REGTYPE
+            tarinfo.size = stat_result.st_size
+        elif stat.S_ISDIR(stat_result.st_mode):
+            tarinfo.type = tarfile.DIRTYPE
+        elif stat.S_ISLNK(stat_result.st_mode):
+            tarinfo.type = tarfile.SYMTYPE
+            tarinfo.linkname = os.readlink(path)
+        else:
+            return None
+
+        return tarinfo
+
+    def _owner(self, uid):
+        """Return cached user name of uid."""
+        if uid not in self._owners:
+            try:
+                self._owners[uid] = pwd.getpwuid(uid).pw_name
+            except KeyError:
+                self._owners[uid] = ''
+        return self._owners[uid]
+
+    def _group(self, gid):
+        """Return cached group name of gid."""
+        if gid not in self._groups:
+            try:
+                self._groups[gid] = grp.getgrgid(gid).gr_name
+            except KeyError:
+                self._groups[gid] = ''
+        return self._groups[gid]
+
+    def add(self, path, arcname):
+        """Write a file, directory or symbolic link to the tar file.
+        Other file types are skipped.
+
+        :path: File path
+        :arcname: Name of the member in the tar file
+        :returns: TarInfo of the written member, or None if skipped
+        :raises: IOError if the file changes size while being read
+        """
+        tarinfo = self.tarinfo(path, arcname)
+        if tarinfo is None:
+            return None
+
+        tarinfo.offset = self.offset
+        self._write(tarinfo.tobuf(tarfile.GNU_FORMAT,
+                                  sys.getfilesystemencoding(),
+                                  'surrogateescape' if six.PY3 else 'strict'))
+        tarinfo.offset_data = self.offset
+
+        checksum = None
+        if tarinfo.isreg():
+            checksum = self._write_data(path, tarinfo.size)
+        self.members += 1
+
+        if self.index is not None:
+            self.index.write(format_index_entry(
+                tarinfo.name,
+                TarIndexEntry(tarinfo.offset, tarinfo.offset_data,
+                              tarinfo.size, checksum)))
+
+        return tarinfo
+
+    def _write_data(self, path, size):
+        """Write file data padded to full blocks.
+
+        :path: File path
+        :size: Number of bytes to write
+        :returns: Checksum of the data for the member index, or None if
+                  no index is written
+        """
+        checksum = None
+        if self.index is not None:
+            checksum = hashlib.new(INDEX_CHECKSUM.lower())
+
+        remaining = size
+        with open(path, 'rb') as infile:
+            while remaining > 0:
+                data = infile.read(min(self.buffer_size, remaining))
+                if not data:
+                    raise IOError("File %s changed size while being "
+                                  "written to tar file" % path)
+                self._write(data)
+                if checksum is not None:
+                    checksum.update(data)
+                remaining -= len(data)
+
+        rest = size % tarfile.BLOCKSIZE
+        if rest > 0:
+            self._write(tarfile.NUL * (tarfile.BLOCKSIZE - rest))
+
+        return checksum.hexdigest() if checksum is not None else None
+
+    def close(self):
+        """Write the end-of-archive marker and pad the tar file to full
+        records.
+        """
+        self._write(tarfile.NUL * (tarfile.BLOCKSIZE * 2))
+        rest = self.offset % tarfile.RECORDSIZE
+        if rest > 0:
+            self._write(tarfile.NUL * (tarfile.RECORDSIZE - rest))
+
+
+def format_index_entry(name, entry):
+    """Format a line of the member index. The fields are separated by
+    tabs and the member name is URL encoded, so that any file name fits
+    on one line.
+
+    :name: Member name
+    :entry: TarIndexEntry of the member
+    :returns: Line of the member index
+    """
+    return '%d\t%d\t%d\t%s\t%s\n' % (
+        entry.offset, entry.offset_data, entry.size, entry.checksum or '-',
+        encode_path(name, safe='/'))
+
 
+def read_tar_index(index_filename):
+    """Read the member index written next to a tar file.
 
-def compress(dir_to_tar, tar_filename):
-    """Create tar file from SIP directory."""
-    command = ['tar', '-cvvf', fsencode_path(tar_filename), '.']
-    proc = subprocess.Popen(
-        command, cwd=dir_to_tar,
-        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT, close_fds=True
-    )
+    :index_filename: Path of the index file
+    :returns: Ordered dict of member names and TarIndexEntry objects
+    """
+    entries = collections.OrderedDict()
+    with io.open(fsencode_path(index_filename), 'rt',
+                 encoding='utf-8') as index_file:
+        for line in index_file:
+            offset, offset_data, size, checksum, name = \
+                line.rstrip('\n').split('\t')
+            entries[decode_path(name)] = TarIndexEntry(
+                int(offset), int(offset_data), int(size),
+                None if checksum == '-' else checksum)
+    return entries
+
+
+def verify_tar_index(index, fixity):
+    """Verify the checksums of the member index, computed while writing
+    the tar file, against the fixity of the digital objects recorded by
+    import-object. No data is read again.
+
+    :index: Member index returned by read_tar_index
+    :fixity: Fixity of the digital objects returned by workspace_fixity
+    :returns: Sorted list of member names that are missing or whose
+              checksum does not match
+    """
+    mismatches = []
+    for path, checksums in six.iteritems(fixity):
+        checksum = checksums.get(INDEX_CHECKSUM)
+        if checksum is None:
+            continue
+        name = './%s' % path
+        entry = index.get(name)
+        if entry is None or entry.checksum != checksum:
+            mismatches.append(name)
+
+    return sorted(mismatches)
+
+
+def iter_member_data(tar_file, entry, buffer_size=BUFFER_SIZE):
+    """Read the data of a tar member directly from its offset.
+
+    :tar_file: Seekable binary file object of the tar file
+    :entry: TarIndexEntry of the member
+    :buffer_size: Number of bytes read at a time
+    :returns: Generator of data blocks
+    :raises: IOError if the tar file ends before the member data
+    """
+    tar_file.seek(entry.offset_data)
+    remaining = entry.size
+    while remaining > 0:
+        data = tar_file.read(min(buffer_size, remaining))
+        if not data:
+            raise IOError("Unexpected end of tar file")
+        remaining -= len(data)
+        yield data
+
+
+def extract_member(tar_filename, name, target, index=None):
+    """Extract one regular file from a tar file by seeking to the offset
+    found in the member index and verify its checksum.
+
+    :tar_filename: Path of the tar file
+    :name: Member name, e.g. "./mets.xml"
+    :target: Path of the extracted file
+    :index: Member index returned by read_tar_index. If None, the index
+            is read from the file next to the tar file.
+    :returns: Path of the extracted file
+    :raises: KeyError if the member is not found in the index,
+             ValueError if the checksum of the extracted data does not
+             match the index
+    """
+    if index is None:
+        index = read_tar_index(tar_filename + INDEX_SUFFIX)
+    entry = index[name]
 
-    proc.communicate()
-    returncode = proc.returncode
+    checksum = hashlib.new(INDEX_CHECKSUM.lower())
+    with open(fsencode_path(tar_filename), 'rb') as tar_file, \
+            open(fsencode_path(target), 'wb') as outfile:
+        for data in iter_member_data(tar_file, entry):
+            checksum.update(data)
+            outfile.write(data)
 
-    print("created tar file: %s" % tar_filename)
+    if entry.checksum is not None and \
+            checksum.hexdigest() != entry.checksum:
+        raise ValueError("Checksum of member %s does not match the index"
+                         % name)
 
-    return returncode
+    return target
 
 
 if __name__ == '__main__':
@@ -1,9 +1,13 @@
 """Command line tool for creating ADDML metadata."""
 from __future__ import unicode_literals
 
+import codecs
+import hashlib
 import io
 import os
+import re
 import sys
+from functools import partial
 
 import six
 import click
@@ -11,13 +15,30 @@ import click
 import addml
 import csv
 import lxml.etree as ET
-from siptools.utils import MdCreator, encode_path
+from siptools.utils import (FLATFILES_SUFFIX, KEY_INDEX_SUFFIX, MdCreator,
+                            collect_filepaths, encode_path, parallel_map)
 
 click.disable_unicode_literals_warning = True
 
+# Number of bytes of a CSV file profiled in one piece
+PROFILE_CHUNK_SIZE = 64 * 1024 * 1024
+
+# Character sets where the newline, delimiter and quoting characters are
+# never part of a multibyte character, so that a file can be split at
+# any newline byte and the pieces can be decoded separately
+SPLITTABLE_CHARSETS = ['ascii', 'utf-8', 'iso8859-1', 'iso8859-15',
+                       'cp1252']
+
+# Replaces quoted fields when profiling CSV files
+_PLACEHOLDER = 'x'
+
+# Record separators given by name, other separators are used as such
+RECORD_SEPARATORS = {'CR+LF': '\r\n', 'CRLF': '\r\n', 'CR': '\r',
+                     'LF': '\n'}
+
 
 @click.command()
-@click.argument('filename', type=str)
+@click.argument('filenames', nargs=-1, required=True, type=str)
 @click.option('--workspace', type=click.Path(exists=True),
               default='./workspace/',
               metavar='<WORKSPACE PATH>',
@@ -42,37 +63,87 @@ click.disable_unicode_literals_warning = True
 @click.option('--quot', type=str, required=True,
               metavar='<QUOTING CHAR>',
               help="Quoting character used in the CSV file")
-def main(filename, charset, delim, sep, quot, header, workspace, base_path):
-    """Tool for creating ADDML metadata for a CSV file. The
+@click.option('--workers', type=int, default=1,
+              metavar='<WORKERS>',
+              help="Number of worker processes reading the CSV headers "
+                   "and profiling the CSV files. Defaults to 1.")
+@click.option('--profile', is_flag=True,
+              help="Read the whole CSV files to count the records, check "
+                   "that all the records have the same number of fields "
+                   "and verify the character encoding.")
+def main(filenames, charset, delim, sep, quot, header, workspace, base_path,
+         workers, profile):
+    """Tool for creating ADDML metadata for CSV files. The
     ADDML metadata is written to <hash>-ADDML-amd.xml
     METS XML file in the workspace directory. The ADDML
     techMD reference is written to md-references.xml.
     If similar ADDML metadata is already found in workspace,
     just the new CSV file name is appended to the existing
-    metadata.
+    metadata. All the CSV files share the given dialect.
 
-    FILENAME: Relative path to the file from current directory or from
-              --base_path.
+    FILENAMES: Relative paths to the files or directories of files from
+               current directory or from --base_path.
     """
     create_addml(
-        filename, charset, delim, sep, quot, header, workspace, base_path
+        filenames, charset, delim, sep, quot, header, workspace, base_path,
+        workers, profile
     )
     return 0
 
 
-def create_addml(filename, charset, delim, sep, quot,
-                 header=False, workspace="./workspace/", base_path="."):
-    """Create ADDML metadata for a CSV file."""
-    filerel = os.path.normpath(filename)
-    filepath = os.path.normpath(os.path.join(base_path, filename))
+def create_addml(filenames, charset, delim, sep, quot,
+                 header=False, workspace="./workspace/", base_path=".",
+                 workers=1, profile=False):
+    """Create ADDML metadata for CSV files. The CSV files with similar
+    metadata share one ADDML section. The headers of the files are read
+    in ``workers`` worker processes.
+
+    :filenames: A file or directory path, or a list of them, in relation
+                to base path
+    :profile: True to profile each CSV file with profile_csv before
+              creating the metadata
+    :raises: ValueError if profiling finds records with different numbers
+             of fields, or data that is not valid in the charset
+    """
+    if isinstance(filenames, six.string_types):
+        filenames = [filenames]
+
+    filepaths = collect_filepaths(dirs=filenames, base=base_path)
+    if profile:
+        for filepath in filepaths:
+            csv_profile = profile_csv(filepath, delim, charset, sep, quot,
+                                      workers)
+            if len(csv_profile['fields']) > 1:
+                raise ValueError(
+                    "Records of %s have different numbers of fields: %s" % (
+                        filepath, ', '.join(
+                            '%d records with %d fields' % (count, fields)
+                            for fields, count
+                            in sorted(csv_profile['fields'].items()))))
+            field_counts = list(csv_profile['fields']) or [0]
+            print("create_addml profiled %s: %d records with %d fields" % (
+                filepath, csv_profile['records'], field_counts[0]))
+    headers = list(parallel_map(
+        partial(csv_header, delimiter=delim, charset=charset,
+                isheader=header),
+        filepaths, workers, chunksize=16))
 
     creator = AddmlCreator(workspace)
-    creator.add_addml_md(
-        filepath, delim,
-        header, charset,
-        sep, quot
-    )
-    creator.write(filerel=filerel)
+    for filepath, csv_file_header in zip(filepaths, headers):
+        # See import_object for the handling of base_path
+        if base_path not in ['.']:
+            filerel = os.path.relpath(filepath, base_path)
+        else:
+            filerel = filepath
+
+        creator.add_addml_md(
+            filepath, delim,
+            header, charset,
+            sep, quot,
+            filerel=filerel,
+            header=csv_file_header
+        )
+    creator.write()
 
 
 class AddmlCreator(MdCreator):
@@ -85,13 +156,58 @@ class AddmlCreator(MdCreator):
         :workspace: Output path
         :etrees: Dict of the generated root elements
         :filenames: Dict of the filenames corresponding to root elements
+        :amd_files: Dict of the IDs and paths of ADDML METS XML files
+                    already written to the workspace by earlier runs
         """
         super(AddmlCreator, self).__init__(workspace)
         self.etrees = {}
         self.filenames = {}
+        self.amd_files = {}
+
+    def _key_index_path(self, key):
+        """Return path of the key index file of ADDML metadata.
+
+        :key: Key of the metadata as created in add_addml_md
+        :returns: File path in the workspace
+        """
+        digest = hashlib.md5('\0'.join(
+            six.text_type(item) for item in key).encode('utf-8')).hexdigest()
+        return os.path.join(self.workspace, digest + KEY_INDEX_SUFFIX)
+
+    def read_key_index(self, key):
+        """Find ADDML metadata written to the workspace by an earlier run
+        with the key index.
+
+        :key: Key of the metadata as created in add_addml_md
+        :returns: Tuple of the ID and path of the ADDML METS XML file, or
+                  None if not found
+        """
+        index_path = self._key_index_path(key)
+        if not os.path.isfile(index_path):
+            return None
+
+        with io.open(index_path, 'rt', encoding='utf-8') as infile:
+            amd_id, amd_name = infile.read().rstrip('\n').split('\t')
+        amd_fname = os.path.join(self.workspace, amd_name)
+        if not os.path.isfile(amd_fname):
+            return None
+
+        return amd_id, amd_fname
+
+    def write_key_index(self, key, amd_id, amd_fname):
+        """Write the ID and file name of ADDML metadata to the key index.
+
+        :key: Key of the metadata as created in add_addml_md
+        :amd_id: ID of the metadata
+        :amd_fname: Path of the ADDML METS XML file
+        """
+        with io.open(self._key_index_path(key), 'wt',
+                     encoding='utf-8') as outfile:
+            outfile.write('%s\t%s\n' % (amd_id, os.path.basename(amd_fname)))
 
     def add_addml_md(self, csv_file, delimiter, isheader,
-                     charset, record_separator, quoting_char):
+                     charset, record_separator, quoting_char,
+                     filerel=None, header=None):
 
         """Append metadata to etrees and filenames dicts.
         All the metadata given as the parameters uniquely defines
@@ -100,6 +216,8 @@ class AddmlCreator(MdCreator):
         to efficiently check if corresponding metadata element has
         already been created. This means that the write_md()
         function needs to be called only once for each distinct metadata types.
+        If the key index of the workspace shows that an earlier run has
+        already written the metadata, the metadata is not created again.
 
         :csv_file: CSV file name
         :delimiter: Delimiter used in the CSV file
@@ -107,18 +225,31 @@ class AddmlCreator(MdCreator):
         :charset: Charset used in the CSV file
         :record_separator: Char used for separating CSV file fields
         :quoting_char: Quotation char used in the CSV file
+        :filerel: Path of the CSV file in the METS document. Defaults to
+                  csv_file.
+        :header: Header of the CSV file as returned by csv_header with
+                 the same isheader, if already read
 
         :returns: None
         """
 
-        header = csv_header(csv_file, delimiter, charset)
+        if header is None:
+            header = csv_header(csv_file, delimiter, charset, isheader)
         headerstr = delimiter.join(header)
-        key = (delimiter, headerstr, charset, record_separator, quoting_char)
+        key = (delimiter, headerstr, charset, record_separator, quoting_char,
+               bool(isheader))
 
         # If similar metadata already exists,
         # only append filename to self.filenames
-        if key in self.etrees:
-            self.filenames[key].append(csv_file)
+        if key in self.filenames:
+            self.filenames[key].append((csv_file, filerel))
+            return
+
+        # If similar metadata was written by an earlier run, reuse it
+        amd_file = self.read_key_index(key)
+        if amd_file is not None:
+            self.amd_files[key] = amd_file
+            self.filenames[key] = [(csv_file, filerel)]
             return
 
         # If similar metadata does not exist, create it
@@ -129,36 +260,44 @@ class AddmlCreator(MdCreator):
         )
 
         self.etrees[key] = metadata
-        self.filenames[key] = [csv_file]
+        self.filenames[key] = [(csv_file, filerel)]
 
     def write(self, mdtype="OTHER", mdtypeversion="8.3", othermdtype="ADDML",
               filerel=None, section=None, stdout=False,
               file_metadata_dict=None):
         """ Write all the METS XML files and md-reference file.
         Base class write is overwritten to handle the references
-        correctly and add flatFile fields to METS XML files.
+        correctly and append flatFile fields for METS XML files.
 
+        :filerel: If given, used as the path of all the CSV files in
+                  references instead of the paths given to add_addml_md
         :returns: None
         """
 
-        for key in self.etrees:
-            metadata = self.etrees[key]
+        for key in self.filenames:
             filenames = self.filenames[key]
 
-            # Create METS XML file
-            amd_id, amd_fname = \
-                self.write_md(metadata, mdtype, mdtypeversion, othermdtype)
+            # Create METS XML file, unless written by an earlier run
+            if key in self.amd_files:
+                amd_id, amd_fname = self.amd_files[key]
+            else:
+                amd_id, amd_fname = self.write_md(
+                    self.etrees[key], mdtype, mdtypeversion, othermdtype)
+                self.write_key_index(key, amd_id, amd_fname)
 
             # Add all the files to references
-            for filename in filenames:
-                self.add_reference(amd_id, filerel if filerel else filename)
-
-            # Append all the flatFile elements to the METS XML file
-            append = [
-                flat_file_str(encode_path(filename), "ref001")
-                for filename in filenames
-            ]
-            append_lines(amd_fname, "<addml:flatFiles>", append)
+            for filename, csv_filerel in filenames:
+                self.add_reference(
+                    amd_id, filerel or csv_filerel or filename)
+
+            # Append the flatFile elements next to the METS XML file.
+            # They are merged into the metadata by compile-mets, so
+            # the METS XML file is never rewritten.
+            with io.open(amd_fname + FLATFILES_SUFFIX, 'at',
+                         encoding='utf-8') as outfile:
+                for filename, _ in filenames:
+                    outfile.write(
+                        '%s\t%s\n' % (encode_path(filename), "ref001"))
 
         # Write md-references
         self.write_references()
@@ -167,21 +306,6 @@ class AddmlCreator(MdCreator):
         self.__init__(self.workspace)
 
 
-def flat_file_str(fname, def_ref):
-    """Returns addml:flatFile xml element as a string,
-    which can be appended to the xml file.
-
-    :fname: Name attribute of the flatFile element
-    :def_ref: definitionReference of the flatFile element
-    """
-
-    flat_file = '<addml:flatFile name="%s" definitionReference="%s"/>\n' % (
-        fname, def_ref
-    )
-
-    return flat_file
-
-
 def _open_csv_file(file_path, charset):
     """
     Open the file in mode dependent on the python version.
@@ -234,32 +358,274 @@ def csv_header(csv_file_path, delimiter, charset, isheader=False,
     return header
 
 
-def append_lines(fname, xml_elem, append):
-    """Append all the lines in list append to file fname below
-    the line with xml_elem.
+def profile_csv(csv_file_path, delimiter, charset, record_separator,
+                quoting_char, workers=1, chunk_size=PROFILE_CHUNK_SIZE):
+    """Profile the structure of a whole CSV file in constant memory. The
+    file is read in pieces of ``chunk_size`` bytes. If the charset allows
+    it, the pieces are split after record separators and profiled in
+    ``workers`` worker processes. A separator may be inside a quoted
+    field, so each
+    piece is profiled both as starting outside and inside quotes, and the
+    right result is chosen when the pieces are combined in order.
+    Otherwise the file is decoded and profiled sequentially.
 
-    :fname: File name
-    :xml_elem: Element below which to append
-    :append: List of lines to append
+    Empty records are not counted.
 
-    :returns: None
+    :csv_file_path: CSV file path
+    :delimiter: Field delimiter in CSV
+    :charset: Character encoding of CSV file
+    :record_separator: Record separator, either a name in
+                       RECORD_SEPARATORS, such as "CR+LF", or the
+                       separator itself
+    :quoting_char: Quotation char used in the CSV file
+    :workers: Number of worker processes
+    :chunk_size: Number of bytes profiled in one piece
+    :returns: Dict with keys "records" (number of records) and "fields"
+              (dict of numbers of fields and numbers of records with them)
+    :raises: ValueError if the file is not valid in the charset or a
+             quoted field is not terminated
     """
+    try:
+        splittable = codecs.lookup(charset).name in SPLITTABLE_CHARSETS
+    except LookupError:
+        raise ValueError("Unknown charset %s" % charset)
+
+    separator = RECORD_SEPARATORS.get(record_separator.upper(),
+                                      record_separator)
+    if not separator:
+        raise ValueError("Empty record separator")
+
+    if splittable:
+        jobs = [(csv_file_path, start, end, delimiter, charset, separator,
+                 quoting_char)
+                for start, end in _csv_chunks(
+                    csv_file_path, separator.encode(charset), chunk_size)]
+        results = parallel_map(_profile_chunk, jobs, workers)
+    else:
+        results = _profile_sequential(csv_file_path, delimiter, charset,
+                                      separator, quoting_char, chunk_size)
+
+    fields = {}
+    carry = (0, False)
+    in_quotes = False
+    for result in results:
+        result = result[1 if in_quotes else 0]
+        first = result['first']
+        if first is None:
+            # No record ends in this piece
+            carry = (carry[0] + result['tail'][0],
+                     carry[1] or result['tail'][1])
+        else:
+            if carry[1] or first[1]:
+                _count_record(fields, carry[0] + first[0] + 1)
+            for field_count, records in six.iteritems(result['counts']):
+                _count_record(fields, field_count, records)
+            carry = result['tail']
+        in_quotes = result['in_quotes']
+
+    if in_quotes:
+        raise ValueError("Quoted field is not terminated in %s" %
+                         csv_file_path)
+    if carry[1]:
+        _count_record(fields, carry[0] + 1)
+
+    return {'records': sum(fields.values()), 'fields': fields}
+
+
+def _count_record(fields, field_count, records=1):
+    """Add records to the numbers of records by number of fields."""
+    fields[field_count] = fields.get(field_count, 0) + records
+
+
+def _csv_chunks(csv_file_path, separator, chunk_size):
+    """Split a file into byte ranges of about ``chunk_size`` bytes, each
+    ending after a record separator or at the end of the file.
 
-    # Read all the lines into memory
-    with io.open(fname, 'rt') as f_in:
-        lines = f_in.readlines()
-
-    # Overwrite the file appending line_content
-    with io.open(fname, 'wt') as f_out:
-
-        for line in lines:
-            f_out.write(line)
-
-            if line.strip() == xml_elem:
-                indent = len(line) - len(line.lstrip()) + 2
+    :csv_file_path: CSV file path
+    :separator: Encoded record separator
+    :chunk_size: Number of bytes in one range
+    :returns: List of tuples of start and end offsets
+    """
+    size = os.path.getsize(csv_file_path)
+    ranges = []
+    start = 0
+    with io.open(csv_file_path, 'rb') as infile:
+        while start < size:
+            end = min(start + chunk_size, size)
+            if end < size:
+                end = _separator_end(infile, end, separator) or size
+            ranges.append((start, end))
+            start = end
+
+    return ranges
+
+
+def _separator_end(infile, offset, separator):
+    """Find the first record separator starting at or after an offset.
+
+    :infile: File opened in binary mode
+    :offset: Byte offset where the search starts
+    :separator: Encoded record separator
+    :returns: Offset after the separator, or None if not found
+    """
+    infile.seek(offset)
+    overlap = b''
+    while True:
+        block = infile.read(64 * 1024)
+        if not block:
+            return None
+        data = overlap + block
+        position = data.find(separator)
+        if position >= 0:
+            return offset - len(overlap) + position + len(separator)
+        # Keep the end of the data, where a separator may begin
+        overlap = data[len(data) - len(separator) + 1:]
+        offset += len(block)
+
+
+def _profile_chunk(job):
+    """Decode and profile one byte range of a CSV file both as starting
+    outside and inside quotes.
+
+    :job: Tuple of file path, start offset, end offset, delimiter,
+          charset, record separator and quoting character
+    :returns: Tuple of results of _profile_records
+    :raises: ValueError if the data is not valid in the charset
+    """
+    (csv_file_path, start, end, delimiter, charset, separator,
+     quoting_char) = job
+    with io.open(csv_file_path, 'rb') as infile:
+        infile.seek(start)
+        data = infile.read(end - start)
+    try:
+        text = data.decode(charset)
+    except UnicodeDecodeError as exception:
+        raise ValueError("Invalid %s data in %s at byte %d" % (
+            charset, csv_file_path, start + exception.start))
+
+    return (_profile_records(text, delimiter, separator, quoting_char,
+                             False),
+            _profile_records(text, delimiter, separator, quoting_char,
+                             True))
+
+
+def _profile_sequential(csv_file_path, delimiter, charset, separator,
+                        quoting_char, chunk_size):
+    """Decode and profile a CSV file in pieces in order. The pieces are
+    not split inside a record separator.
+
+    :returns: Generator of the results of _profile_records, as tuples of
+              the same result for both starting states
+    :raises: ValueError if the data is not valid in the charset
+    """
+    in_quotes = False
+    pending = ''
+    with io.open(csv_file_path, 'rt', encoding=charset,
+                 newline='') as infile:
+        while True:
+            try:
+                text = infile.read(chunk_size)
+            except UnicodeDecodeError:
+                raise ValueError("Invalid %s data in %s" % (charset,
+                                                            csv_file_path))
+            final = not text
+            text = pending + text
+            if not text:
+                break
+            pending = ''
+            if not final and len(separator) > 1:
+                # Leave the characters where a separator may begin to the
+                # next piece, but do not split a separator
+                cut = max(len(text) - len(separator) + 1, 0)
+                position = text.find(separator,
+                                     max(cut - len(separator) + 1, 0))
+                if 0 <= position < cut:
+                    cut = position + len(separator)
+                text, pending = text[:cut], text[cut:]
+            result = _profile_records(text, delimiter, separator,
+                                      quoting_char, in_quotes)
+            in_quotes = result['in_quotes']
+            yield result, result
+            if final:
+                break
+
+
+def _profile_records(text, delimiter, separator, quoting_char, in_quotes):
+    """Count the fields of the records in a piece of CSV data. The first
+    and last record may continue in the adjacent pieces, so they are
+    returned separately as numbers of delimiters.
+
+    Quoted fields are replaced with a placeholder before counting, so
+    that the delimiters and separators inside them are not counted and
+    the records can be counted with string methods instead of a parser.
+
+    :text: Piece of CSV data
+    :delimiter: Field delimiter in CSV
+    :separator: Record separator in CSV
+    :quoting_char: Quotation char used in the CSV file
+    :in_quotes: True if the piece starts inside a quoted field
+    :returns: Dict with keys "first" (tuple of delimiters and True if the
+              first record has data, or None if no record ends in the
+              piece), "counts" (dict of numbers of fields and numbers of
+              the other records ending in the piece), "tail" (tuple of
+              delimiters and data flag of the unfinished record at the
+              end) and "in_quotes" (True if the piece ends inside quotes)
+    """
+    if quoting_char:
+        if in_quotes:
+            text = quoting_char + text
+        quoted = re.compile('%s[^%s]*%s' % ((re.escape(quoting_char),) * 3))
+        text = quoted.sub(_PLACEHOLDER, text)
+        # An unmatched quoting character starts a field that continues
+        # in the next piece
+        unmatched = text.find(quoting_char)
+        in_quotes = unmatched >= 0
+        if in_quotes:
+            text = text[:unmatched] + _PLACEHOLDER
+
+    records = text.split(separator)
+    first = None
+    if len(records) > 1:
+        first = (records[0].count(delimiter),
+                 records[0].strip('\r\n') != '')
+    tail = (records[-1].count(delimiter), records[-1].strip('\r\n') != '')
+
+    counts = {}
+    for record in records[1:-1]:
+        if record.strip('\r\n'):
+            _count_record(counts, record.count(delimiter) + 1)
+
+    return {'first': first, 'counts': counts, 'tail': tail,
+            'in_quotes': in_quotes}
+
+
+def add_flat_files(root, flatfiles_path):
+    """Add the flatFile elements appended by AddmlCreator to the ADDML
+    metadata. The elements are inserted after the existing flatFile
+    elements of the flatFiles element. Repeated file names are added
+    only once.
+
+    :root: Root element of the ADDML METS XML file
+    :flatfiles_path: Path of the file with the flatFile names
 
-                for new_line in append:
-                    f_out.write(" " * indent + new_line)
+    :returns: None
+    """
+    flatfiles = root.find('.//' + addml.addml_ns('flatFiles'))
+    if flatfiles is None:
+        return
+
+    existing = flatfiles.findall(addml.addml_ns('flatFile'))
+    names = set(flatfile.get('name') for flatfile in existing)
+    index = len(existing)
+    with io.open(flatfiles_path, 'rt', encoding='utf-8') as infile:
+        for line in infile:
+            name, def_ref = line.rstrip('\n').split('\t')
+            if name in names:
+                continue
+            names.add(name)
+            flatfiles.insert(
+                index, addml.definition_elems('flatFile', name, def_ref))
+            index += 1
 
 
 def create_addml_metadata(
@@ -268,8 +634,9 @@ def create_addml_metadata(
 ):
 
     """Creates ADDML metadata for a CSV file by default
-    without flatFile element, which is added by the
-    write() method of the AddmlCreator class. This is done to
+    without flatFile element, which is appended by the
+    write() method of the AddmlCreator class and merged by
+    add_flat_files. This is done to
     avoid getting different hashes for the same metadata,
     but different filename.
 
@@ -3,6 +3,7 @@ from __future__ import unicode_literals
 
 import os
 import sys
+from functools import partial
 
 import click
 import six
@@ -17,6 +18,12 @@ FILEDATA_KEYS = ['audio_data_encoding', 'bits_per_sample',
 
 AUDIOINFO_KEYS = ['duration', 'num_channels']
 
+COMPRESSION_KEYS = ['codec_creator_app', 'codec_creator_app_version',
+                    'codec_name', 'codec_quality']
+
+# Stream fields that define the audioMD metadata of a stream
+AUDIOMD_KEYS = FILEDATA_KEYS + COMPRESSION_KEYS + AUDIOINFO_KEYS
+
 ALLOW_UNAV = ['audio_data_encoding', 'codec_creator_app',
               'codec_creator_app_version', 'codec_name',
               'duration', 'num_channels']
@@ -64,28 +71,27 @@ class AudiomdCreator(MdCreator):
     for audio files.
     """
 
-    def add_audiomd_md(self, filepath, filerel=None):
+    def add_audiomd_md(self, filepath, filerel=None, streams=None):
         """Create audioMD metadata for a audio file and append it
-        to self.md_elements.
+        to self.keyed_md. Streams with the same values of AUDIOMD_KEYS
+        share the same audioMD metadata, which is created and written only
+        once.
 
         If a file is not a video container, then the audio stream metadata is
         processed in file level. Video container includes streams which need
         to be processed separately one at a time.
-        """
 
-        # Create audioMD metadata
-        audiomd_dict = create_audiomd_metadata(
-            filepath, filerel, self.workspace
-        )
+        :streams: Scraped streams of the file, if already scraped. The
+                  streams are modified by fixing the missing metadata.
+        """
+        streams = audio_streams(filepath, filerel, self.workspace, streams)
+        file_level = '0' in streams and len(streams) == 1
 
-        if '0' in audiomd_dict and len(audiomd_dict) == 1:
-            self.add_md(metadata=audiomd_dict['0'],
-                        filename=(filerel if filerel else filepath))
-        else:
-            for index, audio in six.iteritems(audiomd_dict):
-                self.add_md(metadata=audio,
-                            filename=(filerel if filerel else filepath),
-                            stream=index)
+        for index, stream_md in six.iteritems(streams):
+            key = tuple(stream_md[field] for field in AUDIOMD_KEYS)
+            self.add_keyed_md(key, partial(audiomd_metadata, stream_md),
+                              filename=(filerel if filerel else filepath),
+                              stream=(None if file_level else index))
 
     def write(self, mdtype="OTHER", mdtypeversion="2.0",
               othermdtype="AudioMD", section=None, stdout=False,
@@ -98,27 +104,47 @@ def create_audiomd_metadata(filename, filerel=None, workspace=None):
     :filename: Audio file path
     :returns: List of AudioMD XML sections.
     """
-    streams = scrape_file(filename, filerel=filerel, workspace=workspace)
+    audiomd_dict = {}
+    for index, stream_md in six.iteritems(
+            audio_streams(filename, filerel, workspace)):
+        audiomd_dict[index] = audiomd_metadata(stream_md)
+
+    return audiomd_dict
+
+
+def audio_streams(filename, filerel=None, workspace=None, streams=None):
+    """Scrape a file and return its audio streams with the missing
+    metadata fixed.
+    :filename: Audio file path
+    :streams: Scraped streams of the file. If None, the file is scraped.
+    :returns: Dict of the audio stream dicts by stream index
+    """
+    if streams is None:
+        streams = scrape_file(filename, filerel=filerel,
+                              workspace=workspace)
     fix_missing_metadata(streams, filename, ALLOW_UNAV, ALLOW_ZERO)
 
-    audiomd_dict = {}
+    audio_dict = {}
     for index, stream_md in six.iteritems(streams):
         if stream_md['stream_type'] != 'audio':
             continue
-        stream_md = _fix_data_rate(stream_md)
-        file_data_elem = _get_file_data(stream_md)
-        audio_info_elem = _get_audio_info(stream_md)
-
-        audiomd_elem = audiomd.create_audiomd(
-            file_data=file_data_elem,
-            audio_info=audio_info_elem
-        )
-        audiomd_dict[six.text_type(index)] = audiomd_elem
+        audio_dict[six.text_type(index)] = _fix_data_rate(stream_md)
 
-    if not audiomd_dict:
+    if not audio_dict:
         raise ValueError('Audio stream info could not be constructed.')
 
-    return audiomd_dict
+    return audio_dict
+
+
+def audiomd_metadata(stream_md):
+    """Creates and returns the audioMD XML section of an audio stream.
+    :stream_md: Audio stream dict
+    :returns: AudioMD XML section
+    """
+    return audiomd.create_audiomd(
+        file_data=_get_file_data(stream_md),
+        audio_info=_get_audio_info(stream_md)
+    )
 
 
 def _fix_data_rate(stream_dict):
@@ -151,10 +177,7 @@ def _get_file_data(stream_dict):
         camel_key = keyparts[0] + ''.join(x.title() for x in keyparts[1:])
         params[camel_key] = stream_dict[key]
 
-    compression = (stream_dict['codec_creator_app'],
-                   stream_dict['codec_creator_app_version'],
-                   stream_dict['codec_name'],
-                   stream_dict['codec_quality'])
+    compression = [stream_dict[key] for key in COMPRESSION_KEYS]
 
     params['compression'] = audiomd.amd_compression(*compression)
 
@@ -4,16 +4,22 @@ from __future__ import unicode_literals
 
 import os
 import sys
+from functools import partial
 
 import click
 import six
 
 import nisomix
-from siptools.utils import MdCreator, scrape_file
+from siptools.utils import (MdCreator, collect_filepaths, parallel_map,
+                            scrape_file)
 
 
 click.disable_unicode_literals_warning = True
 
+# Stream fields that define the MIX metadata of an image
+MIX_KEY_FIELDS = ['compression', 'byte_order', 'colorspace', 'width',
+                  'height', 'bps_value', 'bps_unit', 'samples_per_pixel']
+
 
 SAMPLES_PER_PIXEL = {'1': '1', 'L': '1', 'P': '1', 'RGB': '3', 'YCbCr': '3',
                      'LAB': '3', 'HSV': '3', 'RGBA': '4', 'CMYK': '4',
@@ -34,7 +40,7 @@ class MixGenerationError(ValueError):
 
 @click.command()
 @click.argument(
-    'filename', type=str)
+    'filenames', nargs=-1, required=True, type=str)
 @click.option(
     '--workspace', type=click.Path(exists=True),
     default='./workspace/',
@@ -46,50 +52,90 @@ class MixGenerationError(ValueError):
     metavar='<BASE PATH>',
     help="Source base path of digital objects. If used, give path to "
          "the file in relation to this base path.")
-def main(filename, workspace, base_path):
-    """Write MIX metadata for an image file.
-
-    FILENAME: Relative path to the file from current directory or from
-              --base_path.
+@click.option(
+    '--workers', type=int, default=1,
+    metavar='<WORKERS>',
+    help="Number of worker processes scraping the image files. "
+         "Defaults to 1.")
+def main(filenames, workspace, base_path, workers):
+    """Write MIX metadata for image files.
+
+    FILENAMES: Relative paths to the files or directories of files from
+               current directory or from --base_path.
     """
-    create_mix(filename, workspace, base_path)
+    create_mix(filenames, workspace, base_path, workers)
 
     return 0
 
 
-def create_mix(filename, workspace="./workspace/", base_path="."):
-    """Write MIX metadata for an image file.
+def create_mix(filenames, workspace="./workspace/", base_path=".",
+               workers=1):
+    """Write MIX metadata for image files. The files are scraped in
+    ``workers`` worker processes and all the metadata and references are
+    written once.
 
-    FILENAME: Relative path to the file from current directory or from
-              --base_path.
+    :filenames: A file or directory path, or a list of them, in relation
+                to base path
     """
+    if isinstance(filenames, six.string_types):
+        filenames = [filenames]
+
+    filepaths = collect_filepaths(dirs=filenames, base=base_path)
+    # See import_object for the handling of base_path
+    if base_path not in ['.']:
+        filerels = [os.path.relpath(filepath, base_path)
+                    for filepath in filepaths]
+    else:
+        filerels = filepaths
 
-    filerel = os.path.normpath(filename)
-    filepath = os.path.normpath(os.path.join(base_path, filename))
+    scraped = parallel_map(
+        partial(_scrape_image, workspace=workspace),
+        zip(filepaths, filerels), workers)
 
     creator = MixCreator(workspace)
-    creator.add_mix_md(filepath, filerel)
+    for filepath, filerel, streams in scraped:
+        creator.add_mix_md(filepath, filerel, streams=streams)
     creator.write()
 
 
+def _scrape_image(paths, workspace=None):
+    """Scrape an image file in a worker process.
+
+    :paths: Tuple of the file path and the path in the METS document
+    :workspace: Workspace path
+    :returns: Tuple of the file path, the path in the METS document and
+              the scraped streams
+    """
+    filepath, filerel = paths
+    return filepath, filerel, scrape_file(filepath, filerel=filerel,
+                                          workspace=workspace)
+
+
 class MixCreator(MdCreator):
     """Subclass of MdCreator, which generates MIX metadata for image files.
     """
 
-    def add_mix_md(self, filepath, filerel=None):
+    def add_mix_md(self, filepath, filerel=None, streams=None):
         """Creates  MIX metadata for an image file and append it
-        to self.md_elements
+        to self.keyed_md. Images with the same values of MIX_KEY_FIELDS
+        share the same MIX metadata, which is created and written only
+        once.
 
         :image_file: path to image file
         :file_relpath: relative path to image file to write to reference file
+        :streams: Scraped streams of the image file, if already scraped
         :returns: None
         """
+        if streams is None:
+            streams = scrape_file(filepath, filerel=filerel,
+                                  workspace=self.workspace)
+        stream_md = image_stream(filepath, streams)
+        if stream_md is None:
+            return
 
-        # Create MIX metadata
-        mix = create_mix_metadata(filepath, filerel, self.workspace)
-        if mix is not None:
-            self.add_md(metadata=mix,
-                        filename=(filerel if filerel else filepath))
+        key = tuple(stream_md.get(field) for field in MIX_KEY_FIELDS)
+        self.add_keyed_md(key, partial(mix_metadata, stream_md),
+                          filename=(filerel if filerel else filepath))
 
     # Change the default write parameters
     def write(self, mdtype="NISOIMG", mdtypeversion="2.0", othermdtype=None,
@@ -110,13 +156,33 @@ def check_missing_metadata(stream, filename):
             )
 
 
-def create_mix_metadata(filename, filerel=None, workspace=None):
+def create_mix_metadata(filename, filerel=None, workspace=None,
+                        streams=None):
     """Create MIX metadata XML element for an image file.
 
     :image: image file
+    :streams: Scraped streams of the image file. If None, the file is
+              scraped.
     :returns: MIX XML element
     """
-    streams = scrape_file(filename, filerel=filerel, workspace=workspace)
+    if streams is None:
+        streams = scrape_file(filename, filerel=filerel,
+                              workspace=workspace)
+    stream_md = image_stream(filename, streams)
+    if stream_md is None:
+        return None
+
+    return mix_metadata(stream_md)
+
+
+def image_stream(filename, streams):
+    """Check the scraped streams of an image file and return the image
+    stream.
+
+    :filename: Image file path
+    :streams: Scraped streams of the image file
+    :returns: Stream dict of the image, or None if not an image file
+    """
     stream_md = streams[0]
     check_missing_metadata(stream_md, filename)
 
@@ -127,20 +193,26 @@ def create_mix_metadata(filename, filerel=None, workspace=None):
         raise MixGenerationError(
             'File containing multiple images not supported. File: ', filename
         )
+    if 'byte_order' not in stream_md and \
+            stream_md['mimetype'] == 'image/tiff':
+        raise MixGenerationError(
+            'Byte order missing from TIFF image file ', filename
+        )
+
+    return stream_md
+
+
+def mix_metadata(stream_md):
+    """Create MIX metadata XML element for an image stream.
 
+    :stream_md: Stream dict of the image
+    :returns: MIX XML element
+    """
     mix_compression = nisomix.compression(
         compression_scheme=stream_md["compression"])
-    if 'byte_order' not in stream_md:
-        if stream_md['mimetype'] == 'image/tiff':
-            raise MixGenerationError(
-                'Byte order missing from TIFF image file ', filename
-            )
-        byte_order = None
-    else:
-        byte_order = stream_md["byte_order"]
-
     basic_do_info = nisomix.digital_object_information(
-        byte_order=byte_order, child_elements=[mix_compression])
+        byte_order=stream_md.get("byte_order"),
+        child_elements=[mix_compression])
 
     photom_interpret = nisomix.photometric_interpretation(
         color_space=stream_md["colorspace"])
@@ -3,6 +3,7 @@ from __future__ import unicode_literals
 
 import os
 import sys
+from functools import partial
 
 import click
 import six
@@ -17,6 +18,14 @@ FILEDATA_KEYS = [
     'frame_rate', 'data_rate', 'bits_per_sample', 'data_rate_mode', 'color',
     'signal_format', 'sound', 'duration', 'sampling']
 
+COMPRESSION_KEYS = ['codec_creator_app', 'codec_creator_app_version',
+                    'codec_name', 'codec_quality']
+
+FRAME_KEYS = ['width', 'height', 'par', 'dar']
+
+# Stream fields that define the videoMD metadata of a stream
+VIDEOMD_KEYS = FILEDATA_KEYS + COMPRESSION_KEYS + FRAME_KEYS
+
 ALLOW_UNAV = ['duration', 'codec_creator_app', 'codec_creator_app_version',
               'codec_name', 'dar', 'sampling', 'signal_format']
 ALLOW_ZERO = ['data_rate', 'bits_per_sample', 'frame_rate', 'width',
@@ -62,26 +71,26 @@ class VideomdCreator(MdCreator):
     for video files.
     """
 
-    def add_videomd_md(self, filepath, filerel=None):
-        """Create videoMD metadata and append it to self.md_elements.
+    def add_videomd_md(self, filepath, filerel=None, streams=None):
+        """Create videoMD metadata and append it to self.keyed_md. Streams
+        with the same values of VIDEOMD_KEYS share the same videoMD
+        metadata, which is created and written only once.
 
         If a file is not a video container, then the video stream metadata is
         processed in file level. Video container includes streams which need
         to be processed separately one at a time.
+
+        :streams: Scraped streams of the file, if already scraped. The
+                  streams are modified by fixing the missing metadata.
         """
+        streams = video_streams(filepath, filerel, self.workspace, streams)
+        file_level = '0' in streams and len(streams) == 1
 
-        # Create videoMD metadata
-        videomd_dict = create_videomd_metadata(
-            filepath, filerel, self.workspace
-        )
-        if '0' in videomd_dict and len(videomd_dict) == 1:
-            self.add_md(metadata=videomd_dict['0'],
-                        filename=(filerel if filerel else filepath))
-        else:
-            for index, video in six.iteritems(videomd_dict):
-                self.add_md(metadata=video,
-                            filename=(filerel if filerel else filepath),
-                            stream=index)
+        for index, stream_md in six.iteritems(streams):
+            key = tuple(stream_md[field] for field in VIDEOMD_KEYS)
+            self.add_keyed_md(key, partial(videomd_metadata, stream_md),
+                              filename=(filerel if filerel else filepath),
+                              stream=(None if file_level else index))
 
     def write(self, mdtype="OTHER", mdtypeversion="2.0",
               othermdtype="VideoMD", section=None, stdout=False,
@@ -94,24 +103,44 @@ def create_videomd_metadata(filename, filerel=None, workspace=None):
     :filename: Audio file path
     :returns: List of VideoMD XML sections.
     """
-    streams = scrape_file(filename, filerel=filerel, workspace=workspace)
+    videomd_dict = {}
+    for index, stream_md in six.iteritems(
+            video_streams(filename, filerel, workspace)):
+        videomd_dict[index] = videomd_metadata(stream_md)
+
+    return videomd_dict
+
+
+def video_streams(filename, filerel=None, workspace=None, streams=None):
+    """Scrape a file and return its video streams with the missing
+    metadata fixed.
+    :filename: Video file path
+    :streams: Scraped streams of the file. If None, the file is scraped.
+    :returns: Dict of the video stream dicts by stream index
+    """
+    if streams is None:
+        streams = scrape_file(filename, filerel=filerel,
+                              workspace=workspace)
     fix_missing_metadata(streams, filename, ALLOW_UNAV, ALLOW_ZERO)
 
-    videomd_dict = {}
+    video_dict = {}
     for index, stream_md in six.iteritems(streams):
         if stream_md['stream_type'] != 'video':
             continue
+        video_dict[six.text_type(index)] = stream_md
 
-        file_data_elem = _get_file_data(stream_md)
+    if not video_dict:
+        raise ValueError('Video stream info could not be constructed.')
 
-        videomd_elem = videomd.create_videomd(
-            file_data=file_data_elem)
-        videomd_dict[six.text_type(index)] = videomd_elem
+    return video_dict
 
-    if not videomd_dict:
-        raise ValueError('Video stream info could not be constructed.')
 
-    return videomd_dict
+def videomd_metadata(stream_md):
+    """Creates and returns the videoMD XML section of a video stream.
+    :stream_md: Video stream dict
+    :returns: VideoMD XML section
+    """
+    return videomd.create_videomd(file_data=_get_file_data(stream_md))
 
 
 def _get_file_data(stream_dict):
@@ -126,10 +155,7 @@ def _get_file_data(stream_dict):
         camel_key = keyparts[0] + ''.join(x.title() for x in keyparts[1:])
         params[camel_key] = stream_dict[key]
 
-    compression = (stream_dict['codec_creator_app'],
-                   stream_dict['codec_creator_app_version'],
-                   stream_dict['codec_name'],
-                   stream_dict['codec_quality'])
+    compression = [stream_dict[key] for key in COMPRESSION_KEYS]
 
     params['compression'] = videomd.vmd_compression(*compression)
 
@@ -1,8 +1,8 @@
 """Command line tool for importing digital objects"""
 from __future__ import unicode_literals
 
+import copy
 import datetime
-import fnmatch
 import os
 import platform
 import sys
@@ -13,7 +13,10 @@ import six
 
 import premis
 from file_scraper.scraper import Scraper
-from siptools.utils import MdCreator
+from siptools.scripts.create_audiomd import AudiomdCreator
+from siptools.scripts.create_mix import MixCreator
+from siptools.scripts.create_videomd import VideomdCreator
+from siptools.utils import MdCreator, collect_filepaths
 
 click.disable_unicode_literals_warning = True
 
@@ -100,9 +103,13 @@ UNKNOWN_VERSION = '(:unav)'
     help='Order number of the digital object')
 @click.option(
     '--stdout', is_flag=True, help='Print result also to stdout')
+@click.option(
+    '--techmd', is_flag=True,
+    help='Create also MIX, AudioMD and VideoMD metadata for the image, '
+         'audio and video streams from the same scraping results')
 def main(workspace, base_path, skip_wellformed_check, charset, file_format,
          checksum, date_created, identifier, format_registry, order, stdout,
-         filepaths):
+         techmd, filepaths):
     """Import files to generate digital objects. If parameters --charset,
     --file_format, --identifier, --checksum or --date_created are not given,
     then these are created automatically.
@@ -116,7 +123,7 @@ def main(workspace, base_path, skip_wellformed_check, charset, file_format,
     import_object(
         workspace, base_path, skip_wellformed_check, charset, file_format,
         checksum, date_created, identifier, format_registry, order, stdout,
-        filepaths
+        filepaths, techmd
     )
     return 0
 
@@ -125,13 +132,19 @@ def import_object(workspace="./workspace/", base_path=".",
                   skip_wellformed_check=False, charset=None, file_format=None,
                   checksum=None, date_created=None, identifier=None,
                   format_registry=None, order=None, stdout=False,
-                  filepaths=None):
+                  filepaths=None, techmd=False):
     """Import files to generate digital objects. If parameters charset,
     file_format, identifier, checksum or date_created are not given,
     then these are created automatically.
 
+    If techmd is True, MIX, AudioMD and VideoMD metadata are created from
+    the streams of the same scraping, so that create-mix, create-audiomd
+    and create-videomd do not need to scrape the files again.
+
     :returns: Dictionary of the scraped file metadata
     """
+    techmd_creators = TechmdCreators(workspace) if techmd else None
+
     # Loop files and create premis objects
     files = collect_filepaths(dirs=filepaths, base=base_path)
     for filepath in files:
@@ -158,9 +171,57 @@ def import_object(workspace="./workspace/", base_path=".",
             file_metadata_dict[0]['properties'] = properties
         creator.write(stdout=stdout, file_metadata_dict=file_metadata_dict)
 
+        if techmd_creators:
+            techmd_creators.add_md(filepath, filerel, file_metadata_dict)
+
+    if techmd_creators:
+        techmd_creators.write()
+
     return file_metadata_dict
 
 
+class TechmdCreators(object):
+    """Creators of MIX, AudioMD and VideoMD metadata from scraped streams.
+    The metadata of all the files is written once.
+    """
+
+    def __init__(self, workspace):
+        """
+        :workspace: Output path
+        """
+        self.mix = MixCreator(workspace)
+        self.audiomd = AudiomdCreator(workspace)
+        self.videomd = VideomdCreator(workspace)
+
+    def add_md(self, filepath, filerel, streams):
+        """Add the technical metadata of the image, audio and video streams
+        of a file. The creators modify the streams, so each of them gets a
+        copy.
+
+        :filepath: Path of the file
+        :filerel: Path of the file in the METS document
+        :streams: Scraped streams of the file
+        """
+        stream_types = set(stream['stream_type']
+                           for stream in six.itervalues(streams))
+
+        if 'image' in stream_types:
+            self.mix.add_mix_md(filepath, filerel,
+                                streams=copy.deepcopy(streams))
+        if 'audio' in stream_types:
+            self.audiomd.add_audiomd_md(filepath, filerel,
+                                        streams=copy.deepcopy(streams))
+        if 'video' in stream_types:
+            self.videomd.add_videomd_md(filepath, filerel,
+                                        streams=copy.deepcopy(streams))
+
+    def write(self):
+        """Write the metadata and references of all the creators."""
+        for creator in [self.mix, self.audiomd, self.videomd]:
+            if creator.keyed_md:
+                creator.write()
+
+
 class PremisCreator(MdCreator):
     """Subclass of MdCreator, which generates PREMIS metadata
     for files and streams.
@@ -383,29 +444,6 @@ def create_premis_object(fname, scraper,
     return el_premis_object
 
 
-def collect_filepaths(dirs=None, pattern='*', base='.'):
-    """Collect file paths recursively from given directory. Raises IOError
-    if given path does not exist."""
-
-    if dirs is None:
-        dirs = ['.']
-    files = []
-
-    for directory in dirs:
-        directory = os.path.normpath(os.path.join(base, directory))
-        if os.path.isdir(directory):
-            files += [os.path.join(looproot, filename)
-                      for looproot, _, filenames in os.walk(directory)
-                      for filename in filenames
-                      if fnmatch.fnmatch(filename, pattern)]
-        elif os.path.isfile(directory):
-            files += [directory]
-        else:
-            raise IOError
-
-    return files
-
-
 def creation_date(path_to_file):
     """Try to get the date that a file was created, falling back to when it
     was last modified if that isn't possible.  See
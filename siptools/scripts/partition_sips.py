@@ -0,0 +1,248 @@
+"""Command line tool for partitioning a large dataset into several
+size-bounded SIPs and building them in parallel.
+"""
+from __future__ import unicode_literals
+
+import os
+import re
+import shutil
+import sys
+import uuid
+from functools import partial
+
+import click
+import six
+
+from scandir import scandir
+from siptools.scripts.compile_mets import compile_mets
+from siptools.scripts.compile_structmap import compile_structmap
+from siptools.scripts.import_object import import_object
+from siptools.utils import parallel_map
+from siptools.xml.mets import METS_PROFILE
+
+# Names of the workspace directories of the SIPs
+SIP_WORKSPACE_PATTERN = re.compile(r'^sip-(\d{4,})$')
+
+click.disable_unicode_literals_warning = True
+
+
+@click.command()
+@click.argument('mets_profile', type=click.Choice(METS_PROFILE))
+@click.argument('organization_name', type=str)
+@click.argument('contractid', type=click.UUID)
+@click.argument('source', type=str, default='.')
+@click.option('--workspace',
+              type=click.Path(exists=True, file_okay=False),
+              default='./workspace',
+              metavar='<WORKSPACE PATH>',
+              help='Directory where a workspace is created for each SIP. '
+                   'Defaults to "./workspace".')
+@click.option('--base_path',
+              type=click.Path(exists=True, file_okay=False),
+              default='.',
+              metavar='<BASE PATH>',
+              help='Source base path of the digital objects. If used, give '
+                   'SOURCE in relation to this base path.')
+@click.option('--max_bytes', type=int,
+              metavar='<BYTES>',
+              help='Maximum total size of the digital objects in one SIP.')
+@click.option('--max_files', type=int,
+              metavar='<FILES>',
+              help='Maximum number of digital objects in one SIP.')
+@click.option('--contentid',
+              type=str,
+              metavar='<CONTENTID>',
+              help='Identifier for content shared by all the SIPs. Defaults '
+                   'to a new UUID.')
+@click.option('--skip_wellformed_check', is_flag=True,
+              help='Skip well-formedness check of the digital objects.')
+@click.option('--clean',
+              is_flag=True,
+              help='Remove partial METS documents from the workspaces.')
+@click.option('--workers',
+              type=int, default=1,
+              metavar='<WORKERS>',
+              help='Number of SIPs built in parallel. Defaults to 1.')
+@click.option('--plan_only', is_flag=True,
+              help='Print the partitions without building the SIPs.')
+def main(mets_profile, organization_name, contractid, source, workspace,
+         base_path, max_bytes, max_files, contentid, skip_wellformed_check,
+         clean, workers, plan_only):
+    """Partition a directory of digital objects into SIPs that do not
+    exceed the given limits and build a METS document for each SIP in its
+    own workspace. The directories are split only if they do not fit in
+    one SIP. All the SIPs get the same CONTENTID.
+
+    \b
+    METS_PROFILE: METS profile.
+    ORGANIZATION_NAME: Creator name (organization)
+    CONTRACTID: Contract ID given by the Digital Preservation Service
+    SOURCE: Directory to partition. Defaults to the base path.
+    """
+    partitions = plan_sips(base_path, source, max_bytes, max_files)
+    for index, partition in enumerate(partitions):
+        print("SIP %d: %d files, %d bytes: %s" % (
+            index + 1, partition['files'], partition['size'],
+            ', '.join(partition['paths'])))
+    if plan_only:
+        return 0
+
+    partition_sips(
+        partitions, mets_profile, organization_name, contractid, workspace,
+        base_path, contentid, skip_wellformed_check, clean, workers)
+    return 0
+
+
+def plan_sips(base_path='.', source='.', max_bytes=None, max_files=None):
+    """Partition a directory along directory boundaries. A directory is
+    kept in one SIP if it fits within the limits. Otherwise its files and
+    subdirectories are partitioned separately. The resulting parts are
+    packed sequentially in sorted order: a part is added to the current
+    SIP if it fits, and otherwise a new SIP is started. A single file
+    larger than ``max_bytes`` gets a SIP of its own.
+
+    :base_path: Source base path of the digital objects
+    :source: Directory to partition in relation to base path
+    :max_bytes: Maximum total size of files in a SIP, or None
+    :max_files: Maximum number of files in a SIP, or None
+    :returns: List of partitions, where each partition is a dict with the
+              keys "paths" (list of directories and files in relation to
+              base path), "size" and "files"
+    """
+    tree = _scan_directory(base_path, os.path.normpath(source))
+    partitions = []
+    current = None
+    for path, size, files in _partition_units(tree, max_bytes, max_files):
+        if current is None or not _fits(current['size'] + size,
+                                        current['files'] + files,
+                                        max_bytes, max_files):
+            current = {'paths': [], 'size': 0, 'files': 0}
+            partitions.append(current)
+        current['paths'].append(path)
+        current['size'] += size
+        current['files'] += files
+
+    return partitions
+
+
+def _fits(size, files, max_bytes, max_files):
+    """Return True if the size and number of files are within limits."""
+    return (max_bytes is None or size <= max_bytes) and \
+        (max_files is None or files <= max_files)
+
+
+def _scan_directory(base_path, path):
+    """Scan the sizes and numbers of files of a directory tree.
+
+    :base_path: Source base path
+    :path: Directory path in relation to base path
+    :returns: Dict with the keys "path", "size", "files", "filelist"
+              (sorted list of file paths and sizes) and "dirs" (sorted
+              list of subdirectories as similar dicts)
+    """
+    node = {'path': path, 'size': 0, 'files': 0, 'filelist': [], 'dirs': []}
+    entries = sorted(scandir(os.path.join(base_path, path)),
+                     key=lambda entry: entry.name)
+    for entry in entries:
+        entry_path = os.path.normpath(os.path.join(path, entry.name))
+        if entry.is_dir(follow_symlinks=False):
+            subdir = _scan_directory(base_path, entry_path)
+            node['dirs'].append(subdir)
+            node['size'] += subdir['size']
+            node['files'] += subdir['files']
+        elif entry.is_file():
+            size = entry.stat().st_size
+            node['filelist'].append((entry_path, size))
+            node['size'] += size
+            node['files'] += 1
+
+    return node
+
+
+def _partition_units(node, max_bytes, max_files):
+    """Split a directory tree into the largest parts that fit within the
+    limits.
+
+    :node: Directory tree returned by _scan_directory
+    :max_bytes: Maximum total size of files in a SIP, or None
+    :max_files: Maximum number of files in a SIP, or None
+    :returns: Generator of tuples of path, size and number of files
+    """
+    if node['files'] == 0:
+        return
+    if _fits(node['size'], node['files'], max_bytes, max_files):
+        yield node['path'], node['size'], node['files']
+        return
+
+    for path, size in node['filelist']:
+        yield path, size, 1
+    for subdir in node['dirs']:
+        for unit in _partition_units(subdir, max_bytes, max_files):
+            yield unit
+
+
+def partition_sips(partitions, mets_profile, organization_name, contractid,
+                   workspace='./workspace', base_path='.', contentid=None,
+                   skip_wellformed_check=False, clean=False, workers=1):
+    """Build a METS document for each partition in its own workspace
+    directory. The SIPs are built in ``workers`` worker processes. The
+    workspaces of SIPs left by an earlier run with more SIPs are removed.
+
+    :partitions: Partitions returned by plan_sips
+    :workspace: Directory where the workspaces are created
+    :base_path: Source base path of the digital objects
+    :contentid: Identifier for content shared by all the SIPs. Defaults
+                to a new UUID.
+    :returns: List of workspace paths of the SIPs
+    """
+    if not contentid:
+        contentid = six.text_type(uuid.uuid4())
+
+    build = partial(
+        build_sip, mets_profile=mets_profile,
+        organization_name=organization_name, contractid=contractid,
+        workspace=workspace, base_path=base_path, contentid=contentid,
+        skip_wellformed_check=skip_wellformed_check, clean=clean)
+    jobs = [(index + 1, partition['paths'])
+            for index, partition in enumerate(partitions)]
+
+    for name in os.listdir(workspace):
+        match = SIP_WORKSPACE_PATTERN.match(name)
+        if match and int(match.group(1)) > len(jobs) and \
+                os.path.isdir(os.path.join(workspace, name)):
+            shutil.rmtree(os.path.join(workspace, name))
+
+    return list(parallel_map(build, jobs, workers))
+
+
+def build_sip(job, mets_profile, organization_name, contractid,
+              workspace='./workspace', base_path='.', contentid=None,
+              skip_wellformed_check=False, clean=False):
+    """Import the digital objects of one partition and compile its
+    structural map and METS document in a new workspace. The workspace of
+    the SIP left by an earlier run is removed first, so that its metadata
+    is not mixed with the new metadata.
+
+    :job: Tuple of the SIP number and the list of paths in the SIP
+    :returns: Workspace path of the SIP
+    """
+    number, paths = job
+    sip_workspace = os.path.join(workspace, 'sip-%04d' % number)
+    if os.path.isdir(sip_workspace):
+        shutil.rmtree(sip_workspace)
+    os.makedirs(sip_workspace)
+
+    import_object(workspace=sip_workspace, base_path=base_path,
+                  skip_wellformed_check=skip_wellformed_check,
+                  filepaths=paths)
+    compile_structmap(workspace=sip_workspace)
+    compile_mets(mets_profile, organization_name, contractid,
+                 objid=six.text_type(uuid.uuid4()), contentid=contentid,
+                 workspace=sip_workspace, base_path=base_path, clean=clean)
+
+    return sip_workspace
+
+
+if __name__ == '__main__':
+    RETVAL = main()  # pylint: disable=no-value-for-parameter
+    sys.exit(RETVAL)
@@ -1,8 +1,10 @@
 """Command line tool for creating premis events"""
 from __future__ import unicode_literals
 
+import glob
 import os
 import sys
+from collections import OrderedDict
 from uuid import uuid4
 
 import click
@@ -44,9 +46,11 @@ def _list2str(lst):
               help=("Source base path of event_target. If used, give "
                     "event_target in relation to this base path."))
 @click.option('--event_target',
-              type=str,
+              type=str, multiple=True,
               metavar='<EVENT TARGET PATH>',
-              help=('Target for the event. Default is the root of '
+              help=('Target for the event. Can be given several times, '
+                    'and may be a glob pattern. The same event is linked '
+                    'to all the targets. Default is the root of '
                     'digital objects.'))
 @click.option('--event_detail',
               type=str, required=True,
@@ -98,17 +102,19 @@ def premis_event(event_type, event_datetime, event_detail, event_outcome,
                  event_target=None):
     """The script creates provenance metadata for the package. The metadata
     contains event and, if given, also agent of the event.
+
+    The event and agent are created once and linked to all the targets
+    given in event_target, and md-references.xml is written once.
+
+    :event_target: Target path or glob pattern, or a list of them
     """
-    (directory, event_file) = event_target_path(base_path, event_target)
+    targets = event_targets(base_path, event_target)
 
+    creator = PremisCreator(workspace)
     if agent_name or agent_type:
-        agent_identifier = six.text_type(uuid4())
-        agent = create_premis_agent(agent_name,
-                                    agent_type, agent_identifier)
-
-        agent_creator = PremisCreator(workspace)
-        agent_creator.add_md(agent, event_file, directory=directory)
-        agent_creator.write(mdtype="PREMIS:AGENT", stdout=stdout)
+        for directory, event_file in targets:
+            agent_identifier, agent = creator.add_agent_md(
+                agent_name, agent_type, event_file, directory=directory)
 
         if stdout:
             print(xml_helpers.utils.serialize(agent).decode("utf-8"))
@@ -124,14 +130,59 @@ def premis_event(event_type, event_datetime, event_detail, event_outcome,
         agent_identifier
     )
 
-    creator = PremisCreator(workspace)
-    creator.add_md(event, event_file, directory=directory)
+    # The event is serialized once and referenced from all the targets
+    for directory, event_file in targets:
+        creator.add_keyed_md(event_type, lambda: event, event_file,
+                             directory=directory)
     creator.write(mdtype="PREMIS:EVENT", stdout=stdout)
 
     if stdout:
         print(xml_helpers.utils.serialize(event).decode("utf-8"))
 
 
+def event_targets(base_path, event_target=None):
+    """Expand the event targets to paths. Targets with glob wildcards are
+    matched in relation to base_path. If event_target is None or empty,
+    the event concerns the whole package.
+
+    :base_path: Source base path of the event targets
+    :event_target: Target path or glob pattern, or a list of them
+    :returns: List of tuples of directory and event_file, as returned by
+              event_target_path, each target once
+    :raises: IOError if a target does not exist or a pattern does not
+             match any path
+    """
+    if not event_target:
+        return [event_target_path(base_path)]
+    if isinstance(event_target, six.string_types):
+        event_target = [event_target]
+
+    paths = []
+    for target in event_target:
+        if not any(char in target for char in '*?['):
+            paths.append(target)
+            continue
+
+        if base_path not in ['.']:
+            matches = [os.path.relpath(path, base_path) for path in
+                       glob.glob(os.path.join(base_path, target))]
+        else:
+            matches = glob.glob(target)
+        if not matches:
+            raise IOError("No event targets match %s" % target)
+        paths += sorted(matches)
+
+    targets = []
+    seen = set()
+    for path in paths:
+        target = event_target_path(base_path, path)
+        if target not in seen:
+            seen.add(target)
+            targets.append(target)
+
+    return targets
+
+
 def event_target_path(base_path, event_target=None):
     """Returns the path to the event_target based on the base_path and
     event_target. If event_target is None, the event concerns the whole
@@ -170,8 +221,54 @@ class PremisCreator(MdCreator):
     or agent metadata.
     """
 
+    def __init__(self, workspace):
+        """
+        :workspace: Output path
+        :agents: Dict of tuples (agent identifier, PREMIS agent element)
+                 by agent name and type
+        :agent_targets: Dict of the targets of the agents by agent name and
+                        type. The targets are tuples (filename, directory)
+                        in an ordered dict, to reference each target once.
+        """
+        super(PremisCreator, self).__init__(workspace)
+        self.agents = {}
+        self.agent_targets = {}
+
+    def add_agent_md(self, agent_name, agent_type, filename=None,
+                     directory=None):
+        """Add a PREMIS agent of an event target. An agent with the same
+        name and type is created only once with one identifier. It is
+        written by write() with MDTYPE PREMIS:AGENT and referenced from all
+        of its targets.
+
+        :agent_name: PREMIS agentName
+        :agent_type: PREMIS agentType
+        :filename: Path of the file linking to the agent
+        :directory: Path of the directory linking to the agent
+        :returns: Tuple of the agent identifier and PREMIS agent element
+        """
+        key = (agent_name, agent_type)
+        if key not in self.agents:
+            agent_identifier = six.text_type(uuid4())
+            self.agents[key] = (
+                agent_identifier,
+                create_premis_agent(agent_name, agent_type, agent_identifier))
+            self.agent_targets[key] = OrderedDict()
+        self.agent_targets[key][(filename, directory)] = None
+
+        return self.agents[key]
+
     def write(self, mdtype="PREMIS", mdtypeversion="2.3",
               section="digiprovmd", stdout=False):
+        """Write the agents and the other metadata, and all the references
+        to md-references.xml at once.
+        """
+        for key, (_, agent) in six.iteritems(self.agents):
+            md_id, _ = self.write_md(agent, "PREMIS:AGENT", mdtypeversion,
+                                     section=section)
+            for filename, directory in self.agent_targets[key]:
+                self.add_reference(md_id, filename, directory=directory)
+
         super(PremisCreator, self).write(
             mdtype=mdtype, mdtypeversion=mdtypeversion, section=section)
 
@@ -0,0 +1,169 @@
+"""Command line tool for creating many premis events from an event list"""
+from __future__ import unicode_literals
+
+import csv
+import io
+import json
+import sys
+from functools import partial
+
+import click
+import six
+
+from siptools.scripts.premis_event import (PremisCreator,
+                                           create_premis_event,
+                                           event_target_path)
+from siptools.xml.premis import PREMIS_EVENT_OUTCOME_TYPES, PREMIS_EVENT_TYPES
+
+click.disable_unicode_literals_warning = True
+
+INPUT_FORMATS = ['jsonl', 'csv']
+
+REQUIRED_FIELDS = ['event_type', 'event_datetime', 'event_detail',
+                   'event_outcome']
+
+OPTIONAL_FIELDS = ['event_outcome_detail', 'event_target', 'agent_name',
+                   'agent_type']
+
+# Fields that define the PREMIS event element, in addition to the agent
+EVENT_FIELDS = REQUIRED_FIELDS + ['event_outcome_detail']
+
+
+@click.command()
+@click.argument('event_list', type=click.Path(exists=True, dir_okay=False))
+@click.option('--workspace',
+              type=click.Path(exists=True),
+              default='./workspace',
+              metavar='<WORKSPACE PATH>',
+              help=("Directory where files are created. Defaults "
+                    "to ./workspace/"))
+@click.option('--base_path', type=click.Path(exists=True), default='.',
+              metavar='<BASE PATH>',
+              help=("Source base path of the event targets. If used, give "
+                    "the event targets in relation to this base path."))
+@click.option('--input_format',
+              type=click.Choice(INPUT_FORMATS), default='jsonl',
+              help=('Format of the event list: JSON lines or CSV with a '
+                    'header row. Defaults to jsonl.'))
+def main(event_list, workspace, base_path, input_format):
+    """Create provenance metadata for many events listed in a file. Each
+    event has the fields event_type, event_datetime, event_detail and
+    event_outcome, and optionally event_outcome_detail, event_target,
+    agent_name and agent_type, as the arguments and options of
+    premis-event. Events without event_target concern the whole package.
+
+    \b
+    EVENT_LIST: Path to the event list file.
+    """
+    count = premis_event_list(event_list, workspace, base_path, input_format)
+    print("Created %d events" % count)
+
+    return 0
+
+
+def premis_event_list(event_list, workspace="./workspace", base_path=".",
+                      input_format='jsonl'):
+    """Create PREMIS events and agents for the events listed in a file.
+
+    All the events and agents are created in one process. The agents with
+    the same name and type are created once and linked to all of their
+    events. The events with the same fields and agent are created once and
+    referenced from all of their targets. md-references.xml is written
+    once.
+
+    :event_list: Path to the event list
+    :workspace: Workspace path
+    :base_path: Source base path of the event targets
+    :input_format: "jsonl" or "csv"
+    :returns: Number of the events in the list
+    :raises: ValueError if an event is invalid, IOError if an event target
+             does not exist
+    """
+    creator = PremisCreator(workspace)
+    count = 0
+    for record in read_event_list(event_list, input_format):
+        count += 1
+        event = check_event(record, count)
+        (directory, event_file) = event_target_path(
+            base_path, event['event_target'])
+
+        if event['agent_name']:
+            agent_identifier, _ = creator.add_agent_md(
+                event['agent_name'], event['agent_type'], event_file,
+                directory=directory)
+        else:
+            agent_identifier = None
+
+        event_values = tuple(event[field] for field in EVENT_FIELDS) + \
+            (agent_identifier,)
+        creator.add_keyed_md(
+            event_values, partial(create_premis_event, *event_values),
+            filename=event_file, directory=directory)
+
+    creator.write(mdtype="PREMIS:EVENT")
+
+    return count
+
+
+def read_event_list(event_list, input_format='jsonl'):
+    """Read the events from an event list file.
+
+    :event_list: Path to the event list
+    :input_format: "jsonl" for one JSON object per line, or "csv" for a
+                   CSV file with the field names in the header row
+    :returns: Generator of dicts of the event fields
+    """
+    if input_format == 'csv':
+        if six.PY2:
+            with io.open(event_list, 'rb') as infile:
+                for record in csv.DictReader(infile):
+                    yield dict((key.decode('utf-8'),
+                                value.decode('utf-8') if value else value)
+                               for key, value in six.iteritems(record))
+        else:
+            with io.open(event_list, 'rt', encoding='utf-8',
+                         newline='') as infile:
+                for record in csv.DictReader(infile):
+                    yield record
+    else:
+        with io.open(event_list, 'rt', encoding='utf-8') as infile:
+            for line in infile:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def check_event(record, number):
+    """Check the fields of an event. Empty optional fields are set to None.
+
+    :record: Dict of the event fields
+    :number: Number of the event in the list, for error messages
+    :returns: Dict of all the event fields
+    :raises: ValueError if the event is invalid
+    """
+    unknown = set(record) - set(REQUIRED_FIELDS + OPTIONAL_FIELDS)
+    if unknown:
+        raise ValueError("Unknown fields %s in event %d" % (
+            ', '.join(sorted(unknown)), number))
+
+    event = {}
+    for field in REQUIRED_FIELDS + OPTIONAL_FIELDS:
+        event[field] = record.get(field) or None
+        if field in REQUIRED_FIELDS and event[field] is None:
+            raise ValueError("Missing %s in event %d" % (field, number))
+
+    if event['event_type'] not in PREMIS_EVENT_TYPES:
+        raise ValueError("Invalid event_type %s in event %d" % (
+            event['event_type'], number))
+    if event['event_outcome'] not in PREMIS_EVENT_OUTCOME_TYPES:
+        raise ValueError("Invalid event_outcome %s in event %d" % (
+            event['event_outcome'], number))
+    if bool(event['agent_name']) != bool(event['agent_type']):
+        raise ValueError("Both agent_name and agent_type are required in "
+                         "event %d" % number)
+
+    return event
+
+
+if __name__ == '__main__':
+    RETVAL = main()  # pylint: disable=no-value-for-parameter
+    sys.exit(RETVAL)
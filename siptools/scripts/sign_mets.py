@@ -1,7 +1,9 @@
 """Command line tool for creating digital signatures for SIP"""
 from __future__ import unicode_literals
 
+import glob
 import os
+import re
 import sys
 
 import click
@@ -10,6 +12,9 @@ import dpres_signature.signature
 
 click.disable_unicode_literals_warning = True
 
+# Line of the signed manifest: file name, algorithm and hex digest
+MANIFEST_LINE = re.compile(r'^(.+):([a-z0-9]+):([0-9a-f]+)$')
+
 
 @click.command()
 @click.option(
@@ -19,33 +24,107 @@ click.disable_unicode_literals_warning = True
     help="Workspace directory that contains mets.xml file and where "
          "signature.sig is written. Defaults to ./workspace/"
     )
+@click.option(
+    "--mets_digest", type=str,
+    metavar='<SHA-1 DIGEST>',
+    help="SHA-1 digest of mets.xml given by compile-mets --digest. If "
+         "given, the signature is checked to contain the digest."
+    )
+@click.option(
+    "--include", type=str, multiple=True,
+    metavar='<PATTERN>',
+    help="File or glob pattern in relation to the workspace of other "
+         "package files signed in addition to mets.xml. Can be given "
+         "several times."
+    )
 @click.argument("sign_key", type=click.Path(exists=True))
-def main(sign_key, workspace):
+def main(sign_key, workspace, mets_digest, include):
     """Script for signing the Submission Information Package with a
     digital signature. This script creates signature.sig file.
 
     SIGN_KEY: Private key of the signature keypair.
     """
-    sign_mets(sign_key, workspace)
+    sign_mets(sign_key, workspace, mets_digest, include)
 
     return 0
 
 
-def sign_mets(sign_key, workspace="./workspace"):
+def sign_mets(sign_key, workspace="./workspace", mets_digest=None,
+              include=None):
     """Script for signing the Submission Information Package with a
     digital signature. This script creates signature.sig file.
+
+    If the SHA-1 digest calculated by compile-mets is given, the digest of
+    mets.xml in the signed manifest must be equal to it. This ensures that
+    the signed mets.xml is the one written by compile-mets.
+
+    The files matching the patterns in ``include`` are signed in addition
+    to mets.xml.
+
+    :raises: ValueError if the signed digest does not match mets_digest,
+             or if a pattern in include does not match any file
     """
     signature_path = os.path.join(workspace, 'signature.sig')
+    filenames = signed_files(workspace, include)
+
     signature = dpres_signature.signature.create_signature(
-        signature_path, sign_key, ['mets.xml']
+        signature_path, sign_key, filenames
     )
 
+    if mets_digest and signed_digests(signature).get('mets.xml') != \
+            ('sha1', mets_digest.lower()):
+        raise ValueError(
+            "Digest of mets.xml does not match the given digest %s" %
+            mets_digest)
+
     with open(signature_path, 'wb') as outfile:
         outfile.write(signature)
 
     print("sign_mets created file: %s" % signature_path)
 
 
+def signed_digests(signature):
+    """Parse the digests of the signed files from the manifest of a
+    signature.
+
+    :signature: Signature returned by create_signature
+    :returns: Dict of tuples of algorithm and digest by file name
+    """
+    digests = {}
+    for line in signature.decode('utf-8', 'replace').splitlines():
+        match = MANIFEST_LINE.match(line.strip())
+        if match:
+            digests[match.group(1)] = (match.group(2), match.group(3))
+
+    return digests
+
+
+def signed_files(workspace, include=None):
+    """Expand the files signed in addition to mets.xml.
+
+    :workspace: Workspace path
+    :include: List of file names or glob patterns in relation to the
+              workspace
+    :returns: List of file names in relation to the workspace, mets.xml
+              first and the other files in sorted order
+    :raises: ValueError if a pattern does not match any file
+    """
+    filenames = set()
+    for pattern in include or []:
+        matches = [
+            os.path.relpath(path, workspace)
+            for path in glob.glob(os.path.join(workspace, pattern))
+            if os.path.isfile(path)]
+        if not matches:
+            raise ValueError("No files match %s in %s" % (pattern,
+                                                          workspace))
+        filenames.update(matches)
+
+    filenames.discard('mets.xml')
+    filenames.discard('signature.sig')
+    return ['mets.xml'] + sorted(filenames)
+
+
 if __name__ == '__main__':
     RETVAL = main()  # pylint: disable=no-value-for-parameter
     sys.exit(RETVAL)
@@ -4,11 +4,15 @@ Utilities for siptools
 from __future__ import unicode_literals
 
 import copy
+import fnmatch
 import hashlib
+import io
 import os
 import pickle
 import sys
 from collections import defaultdict
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 
 import six
 
@@ -17,38 +21,50 @@ import mets
 import premis
 import xml_helpers
 from file_scraper.scraper import Scraper
+from siptools.xml.mets import NAMESPACES
 
 try:
     from urllib.parse import quote_plus, unquote_plus
 except ImportError:  # Python 2
     from urllib import quote_plus, unquote_plus
 
+# Suffix of the files mapping a file path to its scraping result
+SCRAPER_INDEX_SUFFIX = '-scraper.idx'
+
+# Suffix of the file next to an ADDML METS XML file, where the flatFile
+# elements of the CSV files sharing the metadata are appended
+FLATFILES_SUFFIX = '.flatfiles'
+
+# Suffix of the workspace files mapping the key of ADDML metadata to the
+# ID and file name of the ADDML METS XML file
+KEY_INDEX_SUFFIX = '-ADDML-key'
+
+# Suffixes of the partial METS documents merged into METS document
+METS_PART_SUFFIXES = ('-amd.xml', 'dmdsec.xml', 'structmap.xml',
+                      'filesec.xml', 'rightsmd.xml')
+
+# Suffixes of all the work files removed from workspace
+WORK_FILE_SUFFIXES = METS_PART_SUFFIXES + ('md-references.xml',
+                                           '-scraper.pkl', FLATFILES_SUFFIX,
+                                           KEY_INDEX_SUFFIX,
+                                           SCRAPER_INDEX_SUFFIX)
+
 
 def scrape_file(filename, filerel=None, workspace=None):
     """Return already existing scraping result or create a new one, if
-    missing.
+    missing. The scraping result is found with the scraper index of the
+    file path, or from md-references.xml if the index is missing.
     """
     if filerel is None:
         filerel = filename
 
-    ref_exists = False
     if workspace is not None:
-        ref = os.path.join(workspace, 'md-references.xml')
-        if os.path.isfile(ref):
-            ref_exists = True
-
-    if ref_exists:
-        root = lxml.etree.parse(ref).getroot()
         filerel = fsdecode_path(filerel)
+        pkl_name = _read_scraper_index(workspace, filerel)
+        if pkl_name is None or not os.path.isfile(pkl_name):
+            pkl_name = _find_scraper_result(workspace, filerel)
 
-        amdref = root.xpath("/mdReferences/mdReference[not(@stream) "
-                            "and @file='%s']" % filerel)
-        pkl_name = None
-        if amdref:
-            pkl_name = os.path.join(
-                workspace, '{}-scraper.pkl'.format(amdref[0].text[1:]))
-
-        if pkl_name and os.path.isfile(pkl_name) and amdref:
+        if pkl_name and os.path.isfile(pkl_name):
             with open(pkl_name, 'rb') as pkl_file:
                 return pickle.load(pkl_file)
 
@@ -57,6 +73,53 @@ def scrape_file(filename, filerel=None, workspace=None):
     return scraper.streams
 
 
+def scraper_index_path(workspace, filerel):
+    """Return path of the scraper index file of a file.
+
+    :workspace: Workspace path
+    :filerel: Path of the file in the METS document
+    :returns: File path in the workspace
+    """
+    digest = hashlib.md5(fsdecode_path(filerel).encode('utf-8')).hexdigest()
+    return os.path.join(workspace, digest + SCRAPER_INDEX_SUFFIX)
+
+
+def _read_scraper_index(workspace, filerel):
+    """Find the scraping result of a file with the scraper index.
+
+    :workspace: Workspace path
+    :filerel: Path of the file in the METS document
+    :returns: Path of the pickled scraping result, or None if not indexed
+    """
+    index_path = scraper_index_path(workspace, filerel)
+    if not os.path.isfile(index_path):
+        return None
+
+    with io.open(index_path, 'rt', encoding='utf-8') as infile:
+        return os.path.join(workspace, infile.read().rstrip('\n'))
+
+
+def _find_scraper_result(workspace, filerel):
+    """Find the scraping result of a file from md-references.xml.
+
+    :workspace: Workspace path
+    :filerel: Path of the file in the METS document
+    :returns: Path of the pickled scraping result, or None if not found
+    """
+    ref = os.path.join(workspace, 'md-references.xml')
+    if not os.path.isfile(ref):
+        return None
+
+    root = lxml.etree.parse(ref).getroot()
+    amdref = root.xpath("/mdReferences/mdReference[not(@stream) "
+                        "and @file='%s']" % filerel)
+    if not amdref:
+        return None
+
+    return os.path.join(
+        workspace, '{}-scraper.pkl'.format(amdref[0].text[1:]))
+
+
 def fix_missing_metadata(streams, filename, allow_unav, allow_zero):
     """If an element is none, use value (:unav) if allowed in the
     specifications. Otherwise raise exception.
@@ -128,6 +191,22 @@ def encode_id(text):
     return '_{}'.format(hashlib.md5(text.encode("utf-8")).hexdigest())
 
 
+def file_checksum(path, algorithm='MD5', chunk_size=1024*1024):
+    """Calculate the checksum of a file.
+
+    :path: File path
+    :algorithm: Checksum algorithm as in PREMIS, e.g. "MD5" or "SHA-256"
+    :chunk_size: Number of bytes read at a time
+    :returns: Checksum as a hexadecimal string
+    """
+    checksum = hashlib.new(algorithm.lower().replace('-', ''))
+    with open(path, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(chunk_size), b''):
+            checksum.update(chunk)
+
+    return checksum.hexdigest()
+
+
 def tree():
     """Tree dictionary data structure from
     https://gist.github.com/hrldcpr/2012250
@@ -225,6 +304,57 @@ def generate_digest(etree):
     return hashlib.md5(xml_data).hexdigest()
 
 
+def parallel_map(func, iterable, workers=1, chunksize=1, threads=False):
+    """Apply function to all the items of iterable and yield the results
+    in the same order as the items were given. If more than one worker is
+    requested, the items are processed in a pool of worker processes, or
+    threads if ``threads`` is True. The function and the items must be
+    picklable when worker processes are used.
+
+    :func: Function to apply
+    :iterable: Items given one at a time to the function
+    :workers: Number of worker processes or threads
+    :chunksize: Number of items sent to a worker at a time
+    :threads: True to use threads instead of processes
+    :returns: Generator of the function results
+    """
+    if workers is None or workers <= 1:
+        for item in iterable:
+            yield func(item)
+        return
+
+    pool = ThreadPool(workers) if threads else Pool(workers)
+    try:
+        for result in pool.imap(func, iterable, chunksize):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def collect_filepaths(dirs=None, pattern='*', base='.'):
+    """Collect file paths recursively from given directory. Raises IOError
+    if given path does not exist."""
+
+    if dirs is None:
+        dirs = ['.']
+    files = []
+
+    for directory in dirs:
+        directory = os.path.normpath(os.path.join(base, directory))
+        if os.path.isdir(directory):
+            files += [os.path.join(looproot, filename)
+                      for looproot, _, filenames in os.walk(directory)
+                      for filename in filenames
+                      if fnmatch.fnmatch(filename, pattern)]
+        elif os.path.isfile(directory):
+            files += [directory]
+        else:
+            raise IOError
+
+    return files
+
+
 def get_objectlist(workspace, file_path=None):
     """Get unique and sorted list of files or streams from md-references.xml
 
@@ -249,6 +379,105 @@ def get_objectlist(workspace, file_path=None):
     return sorted(objectset)
 
 
+def file_md_references(workspace):
+    """Group the file and stream references of md-references.xml by the
+    file path. The reference file is read only once, which is faster than
+    searching the references of each file and stream separately.
+
+    :workspace: Workspace path
+    :returns: Dict of file paths, where each value is a dict with keys
+              "amdids" (set of IDs referenced by the file) and "streams"
+              (dict of stream indexes and sets of IDs referenced by the
+              stream)
+    """
+    reference_file = os.path.join(workspace, 'md-references.xml')
+    references = {}
+    if not os.path.isfile(reference_file):
+        return references
+
+    for _, element in lxml.etree.iterparse(reference_file,
+                                           tag='mdReference'):
+        path = element.get('file')
+        if path is not None:
+            file_refs = references.setdefault(
+                path, {'amdids': set(), 'streams': {}})
+            stream = element.get('stream')
+            if stream is None:
+                file_refs['amdids'].add(element.text)
+            else:
+                file_refs['streams'].setdefault(
+                    stream, set()).add(element.text)
+        element.clear()
+
+    return references
+
+
+def premis_fixity(workspace, file_references):
+    """Read the fixity of a file from the PREMIS object metadata in the
+    workspace, as recorded by import-object.
+
+    :workspace: Workspace path
+    :file_references: References of the file as grouped by
+                      file_md_references
+    :returns: Dict of checksum algorithms and lowercase checksums
+    """
+    fixity = {}
+    for amdid in sorted(file_references.get('amdids', [])):
+        premis_file = os.path.join(workspace, encode_path(
+            '%s-PREMIS:OBJECT-amd.xml' % amdid[1:]))
+        if not os.path.isfile(premis_file):
+            continue
+        for element in lxml.etree.parse(premis_file).xpath(
+                '//premis:object/premis:objectCharacteristics/'
+                'premis:fixity', namespaces=NAMESPACES):
+            algorithm = element.findtext(
+                '{%s}messageDigestAlgorithm' % NAMESPACES['premis'])
+            checksum = element.findtext(
+                '{%s}messageDigest' % NAMESPACES['premis'])
+            if algorithm and checksum:
+                fixity.setdefault(algorithm, checksum.lower())
+
+    return fixity
+
+
+def workspace_fixity(workspace, paths=None):
+    """Collect the fixity of the digital objects in the workspace, so
+    that checksums computed by import-object can be reused instead of
+    reading the files again.
+
+    :workspace: Workspace path
+    :paths: List of file paths. If None, all the files referenced in
+            md-references.xml.
+    :returns: Dict of file paths, where each value is a dict of checksum
+              algorithms and lowercase checksums
+    """
+    references = file_md_references(workspace)
+    if paths is None:
+        paths = sorted(references)
+
+    return dict((path, premis_fixity(workspace, references.get(path, {})))
+                for path in paths)
+
+
+def verify_fixity(path, fixity):
+    """Verify a file against its fixity. The first checksum algorithm
+    supported by hashlib is used.
+
+    :path: File path
+    :fixity: Dict of checksum algorithms and checksums
+    :returns: True if the checksum matches, False if it does not match,
+              and None if no supported checksum is available
+    """
+    for algorithm in sorted(fixity):
+        try:
+            return file_checksum(path, algorithm) == fixity[algorithm].lower()
+        except ValueError:
+            # Unsupported checksum algorithm
+            continue
+
+    return None
+
+
 class MdCreator(object):
     """ Class for generating METS XML and md-references files efficiently.
     """
@@ -259,10 +488,15 @@ class MdCreator(object):
         :md_elements: List of tuples (XML Element, filename, stream,
                       directory)
         :references: List of tuples (md_id, filename, stream, directory)
+        :keyed_md: Dict of metadata XML elements by key
+        :keyed_references: Dict of lists of tuples (filename, stream,
+                           directory) linking to the keyed metadata
         """
         self.workspace = workspace
         self.md_elements = []
         self.references = []
+        self.keyed_md = {}
+        self.keyed_references = {}
 
     def add_reference(self, md_id, filepath, stream=None, directory=None,
                       ref_type='amd'):
@@ -312,6 +546,28 @@ class MdCreator(object):
         md_element = (metadata, filename, stream, directory)
         self.md_elements.append(md_element)
 
+    def add_keyed_md(self, key, create_metadata, filename=None, stream=None,
+                     directory=None):
+        """Add metadata identified by a key. The key is a hashable tuple of
+        the values that uniquely define the metadata, e.g. the technical
+        properties of a stream. The metadata is created only for the first
+        file or stream with the key, and write() serializes and hashes it
+        only once. The rest only get a reference to it.
+
+        :key: Hashable key of the metadata
+        :create_metadata: Function without arguments returning the
+                          metadata XML element
+        :filename: Path of the file linking to the MD element
+        :stream: Stream index, or None if not a stream
+        :directory: Path of the directory linking to the MD element
+
+        :returns: None
+        """
+        if key not in self.keyed_md:
+            self.keyed_md[key] = create_metadata()
+            self.keyed_references[key] = []
+        self.keyed_references[key].append((filename, stream, directory))
+
     def write_references(self):
         """Write "md-references.xml" file, which is read by
         the compile-structmap script when fileSec and structMap elements
@@ -408,14 +664,16 @@ class MdCreator(object):
 
         return md_id, filename
 
-    def write_dict(self, file_metadata_dict, premis_amd_id):
+    def write_dict(self, file_metadata_dict, premis_amd_id, filerel=None):
         """Write streams to a file for further scripts.
         :file_metadata_dict: File metadata dict
         :premis_amd_id: The AMDID of corresponding premis FILE object
+        :filerel: Path of the file in the METS document. If given, the
+                  streams are indexed by the path for scrape_file.
         """
         digest = premis_amd_id[1:]
-        filename = encode_path("%s-scraper.pkl" % digest)
-        filename = os.path.join(self.workspace, filename)
+        pkl_name = encode_path("%s-scraper.pkl" % digest)
+        filename = os.path.join(self.workspace, pkl_name)
 
         if not os.path.exists(filename):
             with open(filename, 'wb') as outfile:
@@ -425,6 +683,11 @@ class MdCreator(object):
                 pickle.dump(file_metadata_dict, outfile)
             print("Wrote technical data to: %s" % (outfile.name))
 
+        if filerel is not None:
+            with io.open(scraper_index_path(self.workspace, filerel), 'wt',
+                         encoding='utf-8') as outfile:
+                outfile.write('%s\n' % pkl_name)
+
     def write(self, mdtype="type", mdtypeversion="version", othermdtype=None,
               section=None, stdout=False, file_metadata_dict=None):
         """Write METS XML and md-reference files. First, METS XML files are
@@ -452,9 +715,19 @@ class MdCreator(object):
                 section=section, stdout=stdout
             )
             if file_metadata_dict and stream is None:
-                self.write_dict(file_metadata_dict, md_id)
+                self.write_dict(file_metadata_dict, md_id, filename)
             self.add_reference(md_id, filename, stream, directory)
 
+        # Write keyed METS XML once per key and reference it from all the
+        # files and streams with the key
+        for key, metadata in six.iteritems(self.keyed_md):
+            md_id, _ = self.write_md(
+                metadata, mdtype, mdtypeversion, othermdtype=othermdtype,
+                section=section, stdout=stdout
+            )
+            for filename, stream, directory in self.keyed_references[key]:
+                self.add_reference(md_id, filename, stream, directory)
+
         # Write md-references
         self.write_references()
 
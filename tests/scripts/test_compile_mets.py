@@ -1,11 +1,15 @@
 """Tests for ``siptools.scripts.compile_mets`` module"""
 from __future__ import unicode_literals
 
+import hashlib
 import os
 
+import pytest
+
 import lxml.etree as ET
-from siptools.scripts import (compile_mets, compile_structmap, import_object,
-                              premis_event)
+import mets
+from siptools.scripts import (compile_mets, compile_structmap, create_addml,
+                              import_object, premis_event)
 from siptools.scripts.import_description import main
 from siptools.xml.mets import NAMESPACES
 
@@ -153,6 +157,148 @@ def test_compile_mets_cleanup_ok(testpath, run_cli):
                       namespaces=NAMESPACES)[0].text == 'CSC'
 
 
+def test_compile_mets_workers(testpath, run_cli):
+    """Test that the METS document compiled with several worker processes
+    contains the same sections as the one compiled serially.
+    """
+    create_test_data(testpath, run_cli)
+    output_file = os.path.join(testpath, 'mets.xml')
+
+    section_ids = []
+    for workers in ['1', '3']:
+        run_cli(compile_mets.main, [
+            'ch', 'CSC', 'urn:uuid:89e92a4f-f0e4-4768-b785-4781d3299b20',
+            '--workspace', testpath, '--workers', workers])
+        root = ET.parse(output_file).getroot()
+        assert len(root.xpath('/mets:mets/mets:amdSec',
+                              namespaces=NAMESPACES)) == 1
+        section_ids.append(sorted(root.xpath(
+            '/mets:mets/*/@ID | /mets:mets/mets:amdSec/*/@ID',
+            namespaces=NAMESPACES)))
+
+    assert section_ids[0] == section_ids[1]
+
+
+def test_compile_mets_digest(testpath, run_cli):
+    """Test that compile_mets returns the SHA-1 digest of mets.xml."""
+    create_test_data(testpath, run_cli)
+    mets_digest = compile_mets.compile_mets(
+        'ch', 'CSC', '89e92a4f-f0e4-4768-b785-4781d3299b20',
+        workspace=testpath, digest=True)
+
+    with open(os.path.join(testpath, 'mets.xml'), 'rb') as mets_file:
+        assert mets_digest == hashlib.sha1(mets_file.read()).hexdigest()
+
+
+def test_clean_metsparts(testpath):
+    """Test that clean_metsparts removes the work files from the root of
+    the workspace, but leaves digital objects untouched.
+    """
+    os.makedirs(os.path.join(testpath, 'data'))
+    for filename in ['abc-NISOIMG-amd.xml', 'structmap.xml',
+                     'object-amd.xml', 'data/copied-amd.xml',
+                     'abc-scraper.pkl', 'abc-ADDML-amd.xml.flatfiles',
+                     'mets.xml']:
+        with open(os.path.join(testpath, filename), 'w') as outfile:
+            outfile.write('foo')
+    with open(os.path.join(testpath, 'md-references.xml'), 'w') as outfile:
+        outfile.write('<mdReferences>'
+                      '<mdReference file="object-amd.xml">_abc</mdReference>'
+                      '</mdReferences>')
+
+    compile_mets.clean_metsparts(testpath)
+
+    assert sorted(os.listdir(testpath)) == ['data', 'mets.xml',
+                                            'object-amd.xml']
+    assert os.listdir(os.path.join(testpath, 'data')) == ['copied-amd.xml']
+
+
+def test_compile_mets_addml(testpath, run_cli):
+    """Test that the flatFile elements of CSV files sharing ADDML metadata
+    are merged into the METS document.
+    """
+    create_test_data(testpath, run_cli)
+    run_cli(create_addml.main, [
+        '--delim', ',', '--charset', 'UTF-8', '--sep', 'CR+LF',
+        '--quot', '"', '--workspace', testpath,
+        'tests/data/simple_csv.csv', 'tests/data/simple_csv_2.csv'])
+
+    compile_mets.compile_mets('ch', 'CSC',
+                              '89e92a4f-f0e4-4768-b785-4781d3299b20',
+                              workspace=testpath)
+
+    root = ET.parse(os.path.join(testpath, 'mets.xml')).getroot()
+    flat_files = root.xpath('//addml:flatFiles/addml:flatFile/@name',
+                            namespaces={'addml': 'http://www.arkivverket.no/'
+                                                 'standarder/addml'})
+    assert flat_files == ['tests%2Fdata%2Fsimple_csv.csv',
+                          'tests%2Fdata%2Fsimple_csv_2.csv']
+
+
+@pytest.mark.parametrize('method', compile_mets.COPY_METHODS)
+def test_copy_objects(testpath, run_cli, method):
+    """Test that digital objects are copied to workspace with all the copy
+    methods and that objects matching the PREMIS fixity are not copied
+    again.
+    """
+    create_test_data(testpath, run_cli)
+    source = 'tests/data/structured/Software files/koodi.java'
+    target = os.path.join(testpath, source)
+
+    assert compile_mets.copy_objects(testpath, '.', method) == 1
+    with open(source, 'rb') as source_file:
+        with open(target, 'rb') as target_file:
+            assert source_file.read() == target_file.read()
+
+    assert compile_mets.copy_objects(testpath, '.', method) == 0
+
+    # Changed target is copied again
+    if not os.path.samefile(source, target):
+        with open(target, 'wb') as target_file:
+            target_file.write(b'foo')
+        assert compile_mets.copy_objects(testpath, '.', method, 2) == 1
+
+
+def test_copy_object_incomplete(testpath, monkeypatch):
+    """Test that an incomplete copy made by a fast copy method is replaced
+    by a full copy.
+    """
+    source = 'tests/data/structured/Software files/koodi.java'
+    target = os.path.join(testpath, 'koodi.java')
+
+    def _truncated_copy(source, target):
+        """Copy only a part of the source file."""
+        with open(source, 'rb') as infile, open(target, 'wb') as outfile:
+            outfile.write(infile.read(4))
+
+    monkeypatch.setattr(compile_mets, '_copy_file_range', _truncated_copy)
+
+    assert compile_mets._copy_object((source, target, {}))
+    with open(source, 'rb') as source_file:
+        with open(target, 'rb') as target_file:
+            assert source_file.read() == target_file.read()
+
+
+def test_merge_sections():
+    """Test that merge_sections merges all amdSec children into one amdSec
+    in the order required by the METS schema and drops duplicate IDs.
+    """
+    sections = [
+        mets.amdsec(child_elements=[mets.digiprovmd('_event')]),
+        mets.structmap(),
+        mets.amdsec(child_elements=[mets.techmd('_tech1')]),
+        mets.amdsec(child_elements=[mets.digiprovmd('_event'),
+                                    mets.techmd('_tech2')])
+    ]
+
+    elements = compile_mets.merge_sections(iter(sections))
+
+    assert [ET.QName(element).localname for element in elements] == \
+        ['amdSec', 'structMap']
+    assert [child.get('ID') for child in elements[0]] == \
+        ['_tech1', '_tech2', '_event']
+
+
 def test_compile_mets_fail(testpath, run_cli):
     arguments = ['ch',
                  'CSC',
@@ -107,6 +107,47 @@ def test_file_and_dir(testpath, run_cli):
     assert elementlist[1].tag == '{%s}div' % NAMESPACES['mets']
 
 
+def test_compile_structmap_workers(testpath, run_cli):
+    """Test that the fileSec created with several worker processes
+    contains the same files in the same order as the one created
+    serially.
+    """
+    run_cli(import_object.main, [
+        '--workspace', testpath, '--skip_wellformed_check',
+        '--base_path', 'tests/data/structured', '.'])
+
+    hrefs = []
+    for workers in ['1', '2']:
+        run_cli(compile_structmap.main, [
+            '--workspace', testpath, '--workers', workers])
+        fs_root = lxml.etree.parse(
+            os.path.join(testpath, 'filesec.xml')).getroot()
+        hrefs.append(fs_root.xpath(
+            '/mets:mets/mets:fileSec/mets:fileGrp/mets:file/mets:FLocat/'
+            '@xlink:href', namespaces=NAMESPACES))
+
+    assert len(hrefs[0]) == 9
+    assert hrefs[0] == hrefs[1]
+
+
+def test_shard_filelist():
+    """Test that the file list is split by the top-level directory
+    without changing the order of the files, consecutive top-level files
+    share a list and long lists are split.
+    """
+    filelist = ['a-b/file', 'a/file1', 'a/sub/file2', 'a0', 'a1', 'b/file',
+                'c']
+    assert compile_structmap.shard_filelist(filelist) == [
+        ['a-b/file'], ['a/file1', 'a/sub/file2'], ['a0', 'a1'], ['b/file'],
+        ['c']]
+
+    filelist = ['data/file%d' % index for index in range(5)] + \
+        ['file%d' % index for index in range(3)]
+    assert compile_structmap.shard_filelist(filelist, shard_size=2) == [
+        ['data/file0', 'data/file1'], ['data/file2', 'data/file3'],
+        ['data/file4'], ['file0', 'file1'], ['file2']]
+
+
 def test_get_md_references(testpath):
     """Test get_md_references function. Copies sample MD reference file
     to workspace and reads the administrative MD IDs for a file.
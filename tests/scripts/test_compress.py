@@ -1,9 +1,14 @@
 from __future__ import unicode_literals
 
+import gzip
+import hashlib
 import os
-import time
+import shutil
 import subprocess
+import tarfile
+import time
 import siptools.scripts.compress
+from siptools.scripts import import_object
 
 
 def test_compress(testpath, run_cli):
@@ -20,3 +25,178 @@ def test_compress(testpath, run_cli):
     child = subprocess.Popen(command)
     child.communicate()
     assert child.returncode == 0
+
+
+def test_compress_member_order(testpath, run_cli):
+    """Test that mets.xml and signature.sig are the first files in the tar
+    file and that the rest of the files follow.
+    """
+    sip = os.path.join(testpath, 'sip')
+    shutil.copytree(os.path.join('tests', 'data', 'structured'), sip)
+    for name in ['signature.sig', 'mets.xml']:
+        with open(os.path.join(sip, name), 'w') as outfile:
+            outfile.write(name)
+    output = os.path.join(testpath, 'sip.tar')
+
+    run_cli(siptools.scripts.compress.main, [
+        sip, '--tar_filename', output, '--readahead', '2'])
+
+    with tarfile.open(output) as tar:
+        names = tar.getnames()
+        assert tar.extractfile('./mets.xml').read() == b'mets.xml'
+
+    assert names[:3] == ['.', './mets.xml', './signature.sig']
+    assert len(names) == len(set(names))
+    assert len([name for name in names if name.endswith('.txt')]) == 8
+
+
+def test_compress_directory_symlink(testpath, run_cli):
+    """Test that a symbolic link to a directory is written as a symbolic
+    link member and that the linked directory is not followed.
+    """
+    sip = os.path.join(testpath, 'sip')
+    os.makedirs(os.path.join(sip, 'data'))
+    with open(os.path.join(sip, 'data', 'file.txt'), 'w') as outfile:
+        outfile.write('foo')
+    os.symlink('data', os.path.join(sip, 'link'))
+    output = os.path.join(testpath, 'sip.tar')
+
+    run_cli(siptools.scripts.compress.main, [sip, '--tar_filename', output])
+
+    with tarfile.open(output) as tar:
+        assert tar.getnames() == ['.', './link', './data',
+                                  './data/file.txt']
+        link = tar.getmember('./link')
+        assert link.issym()
+        assert link.linkname == 'data'
+
+
+def test_compress_output_inside(testpath, run_cli):
+    """Test that the tar file and the member index written inside the
+    directory to be archived are not added to the tar file.
+    """
+    os.makedirs(os.path.join(testpath, 'data'))
+    with open(os.path.join(testpath, 'data', 'file.txt'), 'w') as outfile:
+        outfile.write('foo')
+    output = os.path.join(testpath, 'sip.tar')
+
+    run_cli(siptools.scripts.compress.main, [
+        testpath, '--tar_filename', output, '--index'])
+
+    with tarfile.open(output) as tar:
+        assert tar.getnames() == ['.', './data', './data/file.txt']
+
+
+def test_compress_gzip(testpath, run_cli):
+    """Test that the gzip compressed tar file written in several blocks
+    by several threads contains the same files as the uncompressed one.
+    """
+    dir_to_tar = os.path.join('tests', 'data', 'structured')
+    output = os.path.join(testpath, 'sip.tar')
+    compressed = os.path.join(testpath, 'sip.tar.gz')
+
+    run_cli(siptools.scripts.compress.main, [
+        dir_to_tar, '--tar_filename', output])
+    run_cli(siptools.scripts.compress.main, [
+        dir_to_tar, '--tar_filename', compressed, '--compression', 'gzip',
+        '--threads', '3'])
+
+    with tarfile.open(output) as tar:
+        names = tar.getnames()
+    with tarfile.open(compressed, 'r:gz') as tar:
+        assert tar.getnames() == names
+
+
+def test_parallel_gzip_writer(testpath):
+    """Test that data written in several gzip members decompresses into
+    the original data.
+    """
+    data = os.urandom(1000) * 10
+    output = os.path.join(testpath, 'data.gz')
+    with open(output, 'wb') as outfile:
+        writer = siptools.scripts.compress.ParallelGzipWriter(
+            outfile, threads=2, block_size=1024)
+        for start in range(0, len(data), 700):
+            writer.write(data[start:start + 700])
+        writer.close()
+
+    with gzip.open(output, 'rb') as infile:
+        assert infile.read() == data
+
+
+def test_compress_base_path(testpath, run_cli):
+    """Test that the tar file is built from the METS document in the
+    workspace and the digital objects in the base path, leaving out the
+    work files of the workspace.
+    """
+    base_path = os.path.join('tests', 'data', 'structured')
+    workspace = os.path.join(testpath, 'workspace')
+    os.makedirs(workspace)
+    run_cli(import_object.main, [
+        '--workspace', workspace, '--skip_wellformed_check',
+        '--base_path', base_path, 'Documentation files'])
+    with open(os.path.join(workspace, 'mets.xml'), 'w') as outfile:
+        outfile.write('mets.xml')
+    output = os.path.join(testpath, 'sip.tar')
+
+    run_cli(siptools.scripts.compress.main, [
+        workspace, '--tar_filename', output, '--base_path', base_path])
+
+    with tarfile.open(output) as tar:
+        names = tar.getnames()
+        assert tar.extractfile(
+            './Documentation files/readme.txt').read() == open(
+                os.path.join(base_path, 'Documentation files',
+                             'readme.txt'), 'rb').read()
+
+    assert names[:3] == ['.', './mets.xml', './Documentation files']
+    assert './Documentation files/Notebook' in names
+    assert len([name for name in names if name.endswith('.txt')]) == 5
+    assert len(names) == 12
+    assert not [name for name in names if name.endswith('.xml')
+                and name != './mets.xml']
+
+
+def test_compress_index(testpath, run_cli):
+    """Test that the member index points to the headers and data of the
+    members and that a member is extracted from the index offset.
+    """
+    dir_to_tar = os.path.join('tests', 'data', 'structured')
+    output = os.path.join(testpath, 'sip.tar')
+
+    run_cli(siptools.scripts.compress.main, [
+        dir_to_tar, '--tar_filename', output, '--index'])
+
+    index = siptools.scripts.compress.read_tar_index(output + '.index')
+    with tarfile.open(output) as tar:
+        members = tar.getmembers()
+    assert list(index) == [member.name for member in members]
+    for member in members:
+        assert index[member.name].offset == member.offset
+        assert index[member.name].offset_data == member.offset_data
+
+    name = './Software files/koodi.java'
+    source = os.path.join(dir_to_tar, 'Software files', 'koodi.java')
+    with open(source, 'rb') as infile:
+        data = infile.read()
+    assert index[name].checksum == hashlib.md5(data).hexdigest()
+    target = os.path.join(testpath, 'koodi.java')
+    siptools.scripts.compress.extract_member(output, name, target)
+    with open(target, 'rb') as infile:
+        assert infile.read() == data
+
+
+def test_verify_tar_index():
+    """Test that missing members and members whose checksum does not
+    match the fixity are reported.
+    """
+    entry = siptools.scripts.compress.TarIndexEntry
+    index = {'./a': entry(0, 512, 1, 'aaa'),
+             './b': entry(1024, 1536, 1, 'bbb')}
+    fixity = {'a': {'MD5': 'aaa'},
+              'b': {'MD5': 'xxx'},
+              'c': {'MD5': 'ccc'},
+              'd': {'SHA-256': 'ddd'}}
+
+    assert siptools.scripts.compress.verify_tar_index(index, fixity) == [
+        './b', './c']
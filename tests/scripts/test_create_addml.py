@@ -1,6 +1,7 @@
 """Tests for ``siptools.scripts.create_addml`` module"""
 from __future__ import unicode_literals
 
+import io
 import os
 
 import pytest
@@ -103,7 +104,12 @@ def test_create_addml_creator(testpath, isheader, exp_amd_files, exp_fields):
         amd_file = os.path.join(testpath, exp_amd_file)
         assert os.path.isfile(amd_file)
 
-        root = ET.parse(amd_file)
+        # The flatFile elements are not written to the METS XML file,
+        # but appended next to it and merged when read
+        root = ET.parse(amd_file).getroot()
+        assert root.find(ADDML_NS + "flatFile") is None
+        create_addml.add_flat_files(
+            root, amd_file + create_addml.FLATFILES_SUFFIX)
         flat_files = root.find(ADDML_NS + "flatFiles")
 
         # Verify the number of child elements in flatFiles
@@ -154,6 +160,187 @@ def test_paths(testpath, file_, base_path, run_cli):
     assert os.path.isfile(os.path.normpath(os.path.join(base_path, file_)))
 
 
+def test_create_addml_batch(testpath, run_cli):
+    """Test that several CSV files with similar metadata given in one
+    call share one ADDML section and are all referenced.
+    """
+    run_cli(create_addml.main, [
+        '--delim', ',', '--charset', CHARSET,
+        '--sep', RECORDSEPARATOR, '--quot', QUOTINGCHAR,
+        '--workspace', testpath, '--base_path', 'tests/data',
+        '--workers', '2', 'simple_csv.csv', 'simple_csv_2.csv'])
+
+    amd_files = [name for name in os.listdir(testpath)
+                 if name.endswith('-ADDML-amd.xml')]
+    assert len(amd_files) == 1
+
+    references = ET.parse(os.path.join(testpath, 'md-references.xml'))
+    assert sorted(references.xpath('/mdReferences/mdReference/@file')) == [
+        'simple_csv.csv', 'simple_csv_2.csv']
+    assert len(set(references.xpath(
+        '/mdReferences/mdReference/text()'))) == 1
+
+
+def test_add_flat_files(testpath):
+    """Test that the flatFile elements appended in separate runs are
+    merged after the existing flatFile elements once per file.
+    """
+    for filename in ['tests/data/simple_csv.csv',
+                     'tests/data/simple_csv_2.csv',
+                     'tests/data/simple_csv.csv']:
+        creator = create_addml.AddmlCreator(testpath)
+        creator.add_addml_md(filename, ',', False, CHARSET,
+                             RECORDSEPARATOR, QUOTINGCHAR)
+        creator.write()
+
+    amd_file = os.path.join(
+        testpath, 'ec816a14242f3984e483fa23174881d5-ADDML-amd.xml')
+    with open(amd_file + create_addml.FLATFILES_SUFFIX) as infile:
+        assert len(infile.readlines()) == 3
+
+    root = ET.parse(amd_file).getroot()
+    flat_files = root.find(ADDML_NS + "flatFiles")
+    flat_files.insert(0, create_addml.addml.definition_elems(
+        'flatFile', 'existing', 'ref001'))
+    create_addml.add_flat_files(
+        root, amd_file + create_addml.FLATFILES_SUFFIX)
+
+    assert [decode_path(flat_file.get('name')) for flat_file
+            in flat_files.findall(ADDML_NS[3:] + 'flatFile')] == [
+                'existing', 'tests/data/simple_csv.csv',
+                'tests/data/simple_csv_2.csv']
+
+
+def test_addml_key_index(testpath):
+    """Test that ADDML metadata written by an earlier run is found from
+    the key index and reused without creating the metadata again.
+    """
+    creator = create_addml.AddmlCreator(testpath)
+    creator.add_addml_md('tests/data/simple_csv.csv', ',', False, CHARSET,
+                         RECORDSEPARATOR, QUOTINGCHAR)
+    creator.write()
+
+    creator = create_addml.AddmlCreator(testpath)
+    creator.add_addml_md('tests/data/simple_csv_2.csv', ',', False, CHARSET,
+                         RECORDSEPARATOR, QUOTINGCHAR)
+    assert creator.etrees == {}
+    assert list(creator.amd_files.values()) == [(
+        '_ec816a14242f3984e483fa23174881d5',
+        os.path.join(testpath,
+                     'ec816a14242f3984e483fa23174881d5-ADDML-amd.xml'))]
+    creator.write()
+
+    references = ET.parse(os.path.join(testpath, 'md-references.xml'))
+    assert references.xpath('/mdReferences/mdReference/text()') == [
+        '_ec816a14242f3984e483fa23174881d5'] * 2
+    with open(os.path.join(
+            testpath, 'ec816a14242f3984e483fa23174881d5-ADDML-amd.xml' +
+            create_addml.FLATFILES_SUFFIX)) as infile:
+        assert len(infile.readlines()) == 2
+
+
+def test_addml_key_index_header(testpath, tmpdir, run_cli):
+    """Test that ADDML metadata written by an earlier run is not reused
+    for CSV files with a header, when the header or the use of the header
+    differs.
+    """
+    tmpdir.join('ids.csv').write('id,name\r\n1,a\r\n')
+    tmpdir.join('prices.csv').write('price,qty\r\n2,3\r\n')
+
+    amd_ids = set()
+    fields = []
+    for filename, header in [('ids.csv', []), ('prices.csv', ['--header']),
+                             ('ids.csv', ['--header'])]:
+        run_cli(create_addml.main, [
+            '--delim', ',', '--charset', CHARSET,
+            '--sep', RECORDSEPARATOR, '--quot', QUOTINGCHAR,
+            '--workspace', testpath, '--base_path', str(tmpdir)] +
+                header + [filename])
+
+        # Each run creates new metadata
+        references = ET.parse(os.path.join(testpath, 'md-references.xml'))
+        new_ids = set(references.xpath(
+            '/mdReferences/mdReference/text()')) - amd_ids
+        assert len(new_ids) == 1
+        amd_ids.update(new_ids)
+
+        root = ET.parse(os.path.join(
+            testpath, new_ids.pop()[1:] + '-ADDML-amd.xml')).getroot()
+        fields.append([field.get('name') for field
+                       in root.find(ADDML_NS + 'fieldDefinitions')])
+
+    assert fields == [['header1', 'header2'], ['price', 'qty'],
+                      ['id', 'name']]
+    assert len([name for name in os.listdir(testpath)
+                if name.endswith('-ADDML-amd.xml')]) == 3
+
+
+@pytest.mark.parametrize('charset', ['UTF-8', 'UTF-16'])
+@pytest.mark.parametrize('chunk_size', [5, 1024])
+def test_profile_csv(testpath, charset, chunk_size):
+    """Test that records are counted by number of fields, when quoted
+    fields contain delimiters and newlines and the file is profiled in
+    pieces split inside the quoted fields.
+    """
+    csv_file = os.path.join(testpath, 'quoted.csv')
+    with io.open(csv_file, 'wt', encoding=charset, newline='') as outfile:
+        outfile.write('a,b,c\r\n"x,\ny","z""\r\n",w\r\n\r\n1,2,3\r\n'
+                      '1,2\r\n')
+
+    profile = create_addml.profile_csv(csv_file, ',', charset, 'CR+LF',
+                                       '"', workers=2, chunk_size=chunk_size)
+    assert profile == {'records': 4, 'fields': {3: 3, 2: 1}}
+
+
+@pytest.mark.parametrize('charset', ['UTF-8', 'UTF-16'])
+@pytest.mark.parametrize('chunk_size', [1, 4, 1024])
+@pytest.mark.parametrize('separator, name', [('\r', 'CR'),
+                                             ('\r\n', 'CR+LF'),
+                                             ('\n', 'LF')])
+def test_profile_csv_separator(testpath, charset, chunk_size, separator,
+                               name):
+    """Test that records are split at the given record separator, also
+    when the pieces of the file end inside a separator.
+    """
+    csv_file = os.path.join(testpath, 'separator.csv')
+    with io.open(csv_file, 'wt', encoding=charset, newline='') as outfile:
+        outfile.write(separator.join(['a;b', 'c;d', '"e%sf";g' % separator,
+                                      'h;i;j', '']))
+
+    profile = create_addml.profile_csv(csv_file, ';', charset, name, '"',
+                                       workers=2, chunk_size=chunk_size)
+    assert profile == {'records': 4, 'fields': {2: 3, 3: 1}}
+
+
+def test_profile_csv_errors(testpath, run_cli):
+    """Test that invalid character encoding, unterminated quotes and
+    records with different numbers of fields are errors.
+    """
+    csv_file = os.path.join(testpath, 'invalid.csv')
+    with open(csv_file, 'wb') as outfile:
+        outfile.write(b'a;b\r\n\xff;c\r\n')
+    with pytest.raises(ValueError):
+        create_addml.profile_csv(csv_file, ';', 'UTF-8', 'CR+LF', '"')
+
+    with open(csv_file, 'wb') as outfile:
+        outfile.write(b'a;"b\r\nc;d\r\n')
+    with pytest.raises(ValueError):
+        create_addml.profile_csv(csv_file, ';', 'UTF-8', 'CR+LF', '"')
+
+    with open(csv_file, 'wb') as outfile:
+        outfile.write(b'a;b\r\nc;d;e\r\n')
+    result = run_cli(create_addml.main, [
+        '--delim', DELIMITER, '--charset', CHARSET,
+        '--sep', RECORDSEPARATOR, '--quot', QUOTINGCHAR,
+        '--workspace', testpath, '--profile', csv_file], success=False)
+    assert isinstance(result.exception, ValueError)
+
+    run_cli(create_addml.main, [
+        '--delim', DELIMITER, '--charset', CHARSET,
+        '--sep', RECORDSEPARATOR, '--quot', QUOTINGCHAR,
+        '--workspace', testpath, '--profile', CSV_FILE])
+
+
 @pytest.mark.parametrize("filename, charset", [
     ("tests/data/valid_utf8.csv", "UTF-8"),
     ("tests/data/valid_iso8859-15.csv", "ISO-8859-15"),
@@ -138,8 +138,14 @@ def test_create_audiomd(testpath):
     creator.add_audiomd_md("tests/data/audio/valid__wav.wav")
     creator.add_audiomd_md("tests/data/audio/valid_2_bwf.wav")
 
+    # The streams share the metadata, which is created only once
+    assert len(creator.keyed_md) == 1
+
     creator.write()
 
+    xml = ET.parse(os.path.join(testpath, 'md-references.xml'))
+    assert len(xml.xpath('//mdReference')) == 2
+
     # Check that md-reference and one AudioMD-amd files are created
     assert os.path.isfile(os.path.join(testpath, 'md-references.xml'))
 
@@ -47,6 +47,41 @@ def test_create_mix_techmdfile(testpath):
     assert len(xml.xpath('//mdReference')) == 3
 
 
+def test_mix_keyed_md(testpath):
+    """Test that images with the same technical properties share one MIX
+    metadata element, which is created only once.
+    """
+    creator = create_mix.MixCreator(testpath)
+    for image in ['tiff1.tif', 'tiff2.tif', 'tiff1_compressed.tif']:
+        creator.add_mix_md('tests/data/images/%s' % image)
+
+    assert len(creator.keyed_md) == 2
+    assert sorted(len(references) for references in
+                  creator.keyed_references.values()) == [1, 2]
+
+
+def test_create_mix_batch(testpath, run_cli):
+    """Test that the image files given as a directory are scraped in
+    several workers and MIX metadata is written for all of them.
+    """
+    os.makedirs(os.path.join(testpath, 'data', 'images'))
+    for image in ['tiff1.tif', 'tiff2.tif', 'tiff1_compressed.tif']:
+        shutil.copy('tests/data/images/%s' % image,
+                    os.path.join(testpath, 'data', 'images', image))
+
+    run_cli(create_mix.main, [
+        '--workspace', testpath, '--base_path', testpath,
+        '--workers', '2', 'data'])
+
+    files = os.listdir(testpath)
+    assert len([x for x in files if x.endswith('NISOIMG-amd.xml')]) == 2
+
+    xml = lxml.etree.parse(os.path.join(testpath, 'md-references.xml'))
+    assert len(xml.xpath('//mdReference')) == 3
+    assert len(xml.xpath(
+        '//mdReference[@file="data/images/tiff2.tif"]')) == 1
+
+
 def test_main_utf8_files(testpath, run_cli):
     """Test for ``main`` function with filenames that contain non-ascii
     characters.
@@ -170,8 +170,14 @@ def test_create_videomd(testpath):
     creator.add_videomd_md("tests/data/video/valid_1.m1v")
     creator.add_videomd_md("tests/data/video/valid_1.m1v")
 
+    # The streams share the metadata, which is created only once
+    assert len(creator.keyed_md) == 1
+
     creator.write()
 
+    xml = ET.parse(os.path.join(testpath, 'md-references.xml'))
+    assert len(xml.xpath('//mdReference')) == 2
+
     # Check that mdreference and one VideoMD-amd files are created
     assert os.path.isfile(os.path.join(testpath, 'md-references.xml'))
 
@@ -386,3 +386,34 @@ def test_streams(testpath, run_cli):
     assert len(root.xpath(
         '//premis:relatedObjectIdentifierValue[.="%s"]' % stream_id[1],
         namespaces=NAMESPACES)) == 1
+
+
+def test_import_object_techmd(testpath, run_cli):
+    """Test that --techmd creates MIX, AudioMD and VideoMD metadata for the
+    image, audio and video streams of the imported files.
+    """
+    image_file = 'tests/data/images/tiff1.tif'
+    audio_file = 'tests/data/audio/valid__wav.wav'
+    video_file = 'tests/data/video/valid__h264_aac.mp4'
+    run_cli(import_object.main, [
+        '--workspace', testpath, '--skip_wellformed_check', '--techmd',
+        image_file, audio_file, video_file])
+
+    files = os.listdir(testpath)
+    for suffix, count in [('NISOIMG-amd.xml', 1), ('AudioMD-amd.xml', 2),
+                          ('VideoMD-amd.xml', 1)]:
+        assert len([name for name in files if name.endswith(suffix)]) == \
+            count
+
+    root = ET.parse(os.path.join(testpath, 'md-references.xml')).getroot()
+    for input_file, stream, count in [(image_file, None, 2),
+                                      (audio_file, None, 2),
+                                      (video_file, '1', 2),
+                                      (video_file, '2', 2)]:
+        if stream is None:
+            refs = root.xpath("/mdReferences/mdReference[not(@stream) "
+                              "and @file='%s']" % input_file)
+        else:
+            refs = root.xpath("/mdReferences/mdReference[@stream='%s' and "
+                              "@file='%s']" % (stream, input_file))
+        assert len(refs) == count
@@ -0,0 +1,77 @@
+"""Tests for the partition_sips script."""
+from __future__ import unicode_literals
+
+import os
+
+import lxml.etree
+from siptools.scripts import partition_sips
+from siptools.xml.mets import NAMESPACES
+
+
+def test_plan_sips():
+    """Test that the directories are kept in one SIP when they fit within
+    the limits and split when they do not.
+    """
+    partitions = partition_sips.plan_sips('tests/data/structured',
+                                          max_files=3)
+
+    assert [partition['paths'] for partition in partitions] == [
+        ['Access and use rights files',
+         'Documentation files/readme.txt',
+         'Documentation files/Configuration files'],
+        ['Documentation files/Method files',
+         'Documentation files/Notebook',
+         'Documentation files/Other files'],
+        ['Machine-readable metadata',
+         'Publication files',
+         'Software files']]
+    assert [partition['files'] for partition in partitions] == [3, 3, 3]
+    assert [partition['size'] for partition in partitions] == [6, 6, 6]
+
+    partitions = partition_sips.plan_sips('tests/data/structured',
+                                          max_bytes=100)
+    assert partitions == [{'paths': ['.'], 'size': 18, 'files': 9}]
+
+    partitions = partition_sips.plan_sips('tests/data/structured',
+                                          'Documentation files', max_bytes=1)
+    assert len(partitions) == 5
+
+
+def test_partition_sips(testpath, run_cli):
+    """Test that a METS document with the same CONTENTID is created in
+    a workspace of each SIP and that the SIPs contain all the files. The
+    SIPs are built again by a rerun, and the SIPs of an earlier run are
+    removed by a rerun creating fewer SIPs.
+    """
+    for _ in range(2):
+        run_cli(partition_sips.main, [
+            'ch', 'CSC', 'urn:uuid:89e92a4f-f0e4-4768-b785-4781d3299b20',
+            '--workspace', testpath, '--base_path', 'tests/data/structured',
+            '--max_files', '4', '--contentid', 'Aineisto-123',
+            '--skip_wellformed_check', '--workers', '2'])
+
+    hrefs = []
+    for workspace in ['sip-0001', 'sip-0002', 'sip-0003']:
+        root = lxml.etree.parse(
+            os.path.join(testpath, workspace, 'mets.xml')).getroot()
+        assert root.get('{%s}CONTENTID' % NAMESPACES['fi']) \
+            == 'Aineisto-123'
+        hrefs += root.xpath('//mets:FLocat/@xlink:href',
+                            namespaces=NAMESPACES)
+
+    assert not os.path.exists(os.path.join(testpath, 'sip-0004'))
+    assert len(hrefs) == 9
+    assert 'file://Software+files/koodi.java' in hrefs
+
+    run_cli(partition_sips.main, [
+        'ch', 'CSC', 'urn:uuid:89e92a4f-f0e4-4768-b785-4781d3299b20',
+        '--workspace', testpath, '--base_path', 'tests/data/structured',
+        '--max_files', '100', '--contentid', 'Aineisto-123',
+        '--skip_wellformed_check'])
+
+    assert sorted(name for name in os.listdir(testpath)
+                  if name.startswith('sip-')) == ['sip-0001']
+    root = lxml.etree.parse(
+        os.path.join(testpath, 'sip-0001', 'mets.xml')).getroot()
+    assert len(root.xpath('//mets:FLocat/@xlink:href',
+                          namespaces=NAMESPACES)) == 9
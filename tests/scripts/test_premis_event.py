@@ -136,6 +136,50 @@ def test_amd_links_dir(testpath, run_cli):
     assert dir_ref == target
 
 
+def test_amd_links_many_targets(testpath, run_cli):
+    """Tests that one event and agent are linked to all the targets given
+    as paths and glob patterns.
+    """
+    run_cli(premis_event.main, [
+        'creation',
+        '2016-10-13T12:30:55',
+        '--event_detail', 'Testing',
+        '--event_outcome', 'success',
+        '--workspace', testpath,
+        '--base_path', 'tests/data',
+        '--event_target', 'structured',
+        '--event_target', 'test_import.pdf',
+        '--event_target', 'text-file.*',
+        '--event_target', 'test_import.pdf',
+        '--agent_name', 'Demo Application',
+        '--agent_type', 'software'
+    ])
+
+    files = os.listdir(testpath)
+    assert len([name for name in files
+                if name.endswith('-PREMIS%3AEVENT-amd.xml')]) == 1
+    assert len([name for name in files
+                if name.endswith('-PREMIS%3AAGENT-amd.xml')]) == 1
+
+    root = ET.parse(os.path.join(testpath, 'md-references.xml')).getroot()
+    assert len(root.xpath("/mdReferences/mdReference")) == 6
+    for attribute, target in [('directory', 'structured'),
+                              ('file', 'test_import.pdf'),
+                              ('file', 'text-file.txt')]:
+        assert len(root.xpath("/mdReferences/mdReference[@%s='%s']" % (
+            attribute, target))) == 2
+
+    result = run_cli(premis_event.main, [
+        'creation',
+        '2016-10-13T12:30:55',
+        '--event_detail', 'Testing',
+        '--event_outcome', 'success',
+        '--workspace', testpath,
+        '--event_target', 'tests/data/missing*'
+    ], success=False)
+    assert isinstance(result.exception, IOError)
+
+
 def test_premis_event_fail(testpath, run_cli):
     """Test that main function raises `SystemExit` if `event_outcome`
     parameter is incorrect."""
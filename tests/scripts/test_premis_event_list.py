@@ -0,0 +1,91 @@
+"""Tests for :mod:`siptools.scripts.premis_event_list` module"""
+from __future__ import unicode_literals
+
+import io
+import json
+import os
+
+import pytest
+
+import lxml.etree as ET
+from siptools.scripts import premis_event_list
+
+EVENTS = [
+    {'event_type': 'migration', 'event_datetime': '2016-10-13T12:30:55',
+     'event_detail': 'Migrated', 'event_outcome': 'success',
+     'event_target': 'tests/data/test_import.pdf',
+     'agent_name': 'Demo Application', 'agent_type': 'software'},
+    {'event_type': 'migration', 'event_datetime': '2016-10-13T12:30:55',
+     'event_detail': 'Migrated', 'event_outcome': 'success',
+     'event_target': 'tests/data/text-file.txt',
+     'agent_name': 'Demo Application', 'agent_type': 'software'},
+    {'event_type': 'creation', 'event_datetime': '2016-10-13T12:30:55',
+     'event_detail': 'Testing', 'event_outcome': 'success',
+     'event_outcome_detail': 'Outcome detail'}
+]
+
+
+def _check_output(workspace):
+    """Check the metadata files and references written for EVENTS."""
+    files = os.listdir(workspace)
+    assert len([name for name in files
+                if name.endswith('-PREMIS%3AAGENT-amd.xml')]) == 1
+    assert len([name for name in files
+                if name.endswith('-PREMIS%3AEVENT-amd.xml')]) == 2
+
+    root = ET.parse(os.path.join(workspace, 'md-references.xml')).getroot()
+    references = root.xpath('/mdReferences/mdReference')
+    assert len(references) == 5
+    assert len(root.xpath(
+        "/mdReferences/mdReference[@file='tests/data/text-file.txt']")) == 2
+    assert len(root.xpath(
+        "/mdReferences/mdReference[@directory='.']")) == 1
+
+
+def test_premis_event_list_jsonl(testpath, run_cli):
+    """Test that the events of a JSON lines file are created with one agent
+    and that the identical events share the metadata.
+    """
+    event_list = os.path.join(testpath, 'events.jsonl')
+    with io.open(event_list, 'wt', encoding='utf-8') as outfile:
+        for event in EVENTS:
+            outfile.write('%s\n' % json.dumps(event))
+
+    workspace = os.path.join(testpath, 'workspace')
+    os.makedirs(workspace)
+    run_cli(premis_event_list.main, [
+        '--workspace', workspace, event_list])
+
+    _check_output(workspace)
+
+
+def test_premis_event_list_csv(testpath):
+    """Test that the events of a CSV file are created."""
+    fields = premis_event_list.REQUIRED_FIELDS + \
+        premis_event_list.OPTIONAL_FIELDS
+    event_list = os.path.join(testpath, 'events.csv')
+    with io.open(event_list, 'wt', encoding='utf-8') as outfile:
+        outfile.write('%s\n' % ','.join(fields))
+        for event in EVENTS:
+            outfile.write('%s\n' % ','.join(
+                event.get(field, '') for field in fields))
+
+    workspace = os.path.join(testpath, 'workspace')
+    os.makedirs(workspace)
+    assert premis_event_list.premis_event_list(
+        event_list, workspace, input_format='csv') == 3
+
+    _check_output(workspace)
+
+
+@pytest.mark.parametrize('record', [
+    {'event_type': 'creation'},
+    dict(EVENTS[2], event_type='nonsense'),
+    dict(EVENTS[2], event_outcome='nonsense'),
+    dict(EVENTS[2], agent_name='Demo Application'),
+    dict(EVENTS[2], unknown='value')
+])
+def test_check_event_invalid(record):
+    """Test that invalid events raise ValueError."""
+    with pytest.raises(ValueError):
+        premis_event_list.check_event(record, 1)
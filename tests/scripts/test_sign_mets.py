@@ -21,3 +21,79 @@ def test_valid_sign_mets(testpath, run_cli):
 
     with io.open(output, "rt") as open_file:
         assert "4ddd69b778405b4072d77762a85f9cf5e8e5ca83" in open_file.read()
+
+
+def test_sign_mets_digest(testpath, run_cli):
+    """Test that signing succeeds with the correct digest of mets.xml and
+    fails with a wrong digest.
+    """
+    signing_key = 'tests/data/rsa-keys.crt'
+    shutil.copy('tests/data/text-file.txt',
+                os.path.join(testpath, 'mets.xml'))
+
+    run_cli(siptools.scripts.sign_mets.main, [
+        '--workspace', testpath,
+        '--mets_digest', '4DDD69B778405B4072D77762A85F9CF5E8E5CA83',
+        signing_key])
+
+    result = run_cli(siptools.scripts.sign_mets.main, [
+        '--workspace', testpath,
+        '--mets_digest', '0' * 40,
+        signing_key], success=False)
+    assert isinstance(result.exception, ValueError)
+
+    # The digest must match the line of mets.xml exactly, not a part of it
+    # or another line of the signature
+    fake_digest = 'ab' * 20
+    with open(os.path.join(testpath, '%s.xml' % fake_digest), 'w') as outfile:
+        outfile.write('foo')
+    for digest in [fake_digest, '4ddd69b778405b40']:
+        result = run_cli(siptools.scripts.sign_mets.main, [
+            '--workspace', testpath, '--include', '*.xml',
+            '--mets_digest', digest, signing_key], success=False)
+        assert isinstance(result.exception, ValueError)
+
+
+def test_signed_digests():
+    """Test that the digests are parsed from the signed manifest."""
+    signature = (
+        b'Content-Type: text/plain\r\n\r\n'
+        b'mets.xml:sha1:4ddd69b778405b4072d77762a85f9cf5e8e5ca83\r\n'
+        b'a:b.xml:sha1:abababababababababababababababababababab\r\n'
+        b'\r\n------ABCD\r\n')
+    assert siptools.scripts.sign_mets.signed_digests(signature) == {
+        'mets.xml': ('sha1', '4ddd69b778405b4072d77762a85f9cf5e8e5ca83'),
+        'a:b.xml': ('sha1', 'abababababababababababababababababababab')}
+
+
+def test_sign_mets_include(testpath, run_cli):
+    """Test that the files matching the include patterns are signed in
+    addition to mets.xml.
+    """
+    signing_key = 'tests/data/rsa-keys.crt'
+    shutil.copy('tests/data/text-file.txt',
+                os.path.join(testpath, 'mets.xml'))
+    os.makedirs(os.path.join(testpath, 'metadata'))
+    for name in ['a.xml', 'b.xml', 'c.txt']:
+        with open(os.path.join(testpath, 'metadata', name), 'w') as outfile:
+            outfile.write(name)
+
+    assert siptools.scripts.sign_mets.signed_files(
+        testpath, ['metadata/*.xml', 'mets.xml']) == [
+            'mets.xml', 'metadata/a.xml', 'metadata/b.xml']
+
+    run_cli(siptools.scripts.sign_mets.main, [
+        '--workspace', testpath, '--include', 'metadata/*.xml',
+        signing_key])
+
+    with io.open(os.path.join(testpath, 'signature.sig'), "rt") as infile:
+        signature = infile.read()
+    assert "4ddd69b778405b4072d77762a85f9cf5e8e5ca83" in signature
+    assert "metadata/a.xml" in signature
+    assert "metadata/b.xml" in signature
+    assert "metadata/c.txt" not in signature
+
+    result = run_cli(siptools.scripts.sign_mets.main, [
+        '--workspace', testpath, '--include', 'missing/*', signing_key],
+        success=False)
+    assert isinstance(result.exception, ValueError)
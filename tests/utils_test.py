@@ -2,10 +2,12 @@
 """Tests for the utility functions."""
 from __future__ import unicode_literals
 
+import hashlib
 import os
 import lxml.etree
 import xml_helpers
 import siptools.utils as utils
+from siptools.scripts.import_object import import_object
 
 
 def test_encode_path():
@@ -97,6 +99,52 @@ def test_add_mdreference(testpath):
     assert reference[0].text == 'abcd1234'
 
 
+def test_add_keyed_md(testpath):
+    """Test that keyed metadata is created and written only once per key
+    and that all the files with the key reference it.
+    """
+    md_creator = utils.MdCreator(testpath)
+    created = []
+
+    def create_metadata():
+        """Create a sample metadata element."""
+        created.append(True)
+        return lxml.etree.Element('sampleData')
+
+    md_creator.add_keyed_md(('a', 1), create_metadata, 'path/to/file1')
+    md_creator.add_keyed_md(('a', 1), create_metadata, 'path/to/file2')
+    md_creator.add_keyed_md(('a', 1), create_metadata, 'path/to/file3',
+                            stream=1)
+    assert len(created) == 1
+
+    md_creator.write('NISOIMG', '2.0')
+
+    files = [name for name in os.listdir(testpath)
+             if name.endswith('-NISOIMG-amd.xml')]
+    assert files == ['455752263d67f67402b0dc9e7119e5b3-NISOIMG-amd.xml']
+
+    etree = lxml.etree.parse(os.path.join(testpath, 'md-references.xml'))
+    references = etree.xpath('/mdReferences/mdReference')
+    assert len(references) == 3
+    assert set(ref.text for ref in references) == set(
+        ['_455752263d67f67402b0dc9e7119e5b3'])
+    assert references[2].get('stream') == '1'
+
+
+def test_scraper_index(testpath):
+    """Test that scrape_file finds the scraping result written by
+    write_dict with the scraper index, without md-references.xml.
+    """
+    streams = {0: {'stream_type': 'text', 'mimetype': 'text/plain'}}
+    md_creator = utils.MdCreator(testpath)
+    md_creator.write_dict(streams, '_abcd1234', 'data/äöå.txt')
+
+    assert os.path.isfile(utils.scraper_index_path(testpath,
+                                                   'data/äöå.txt'))
+    assert not os.path.isfile(os.path.join(testpath, 'md-references.xml'))
+    assert utils.scrape_file('data/äöå.txt', workspace=testpath) == streams
+
+
 def test_copy_etree():
     """Test that copy_etree creates a new lxml.etree
     instance with identical data.
@@ -193,3 +241,44 @@ def test_remove_dmdsec_references(testpath):
 
     assert not root.xpath('/mdReferences/mdReference[@ref_type="dmd"]')
     assert len(root.xpath('/mdReferences/*')) == 3
+
+
+def test_file_md_references(testpath):
+    """Test that file_md_references groups the file and stream references
+    by the file path and ignores directory references.
+    """
+    md_creator = utils.MdCreator(testpath)
+    md_creator.add_reference('_file1', 'path/to/file1')
+    md_creator.add_reference('_file2', 'path/to/file2')
+    md_creator.add_reference('_file2b', 'path/to/file2')
+    md_creator.add_reference('_stream1', 'path/to/file2', stream='1')
+    md_creator.add_reference('_stream2', 'path/to/file2', stream='2')
+    md_creator.add_reference('_dir', None, directory='path')
+    md_creator.write_references()
+
+    references = utils.file_md_references(testpath)
+
+    assert references == {
+        'path/to/file1': {'amdids': set(['_file1']), 'streams': {}},
+        'path/to/file2': {'amdids': set(['_file2', '_file2b']),
+                          'streams': {'1': set(['_stream1']),
+                                      '2': set(['_stream2'])}}
+    }
+    assert utils.file_md_references(os.path.join(testpath, 'foo')) == {}
+
+
+def test_workspace_fixity(testpath):
+    """Test that the fixity recorded by import-object is found for the
+    imported file and that the file is verified against it.
+    """
+    path = 'tests/data/structured/Software files/koodi.java'
+    import_object(workspace=testpath, skip_wellformed_check=True,
+                  filepaths=[path])
+    with open(path, 'rb') as infile:
+        checksum = hashlib.md5(infile.read()).hexdigest()
+
+    fixity = utils.workspace_fixity(testpath)
+    assert fixity == {path: {'MD5': checksum}}
+    assert utils.verify_fixity(path, fixity[path]) is True
+    assert utils.verify_fixity(path, {'MD5': '0' * 32}) is False
+    assert utils.verify_fixity(path, {'foo': 'bar'}) is None